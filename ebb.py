@@ -23,42 +23,126 @@
 
 import abc
 import cgi
+import collections
 import contextlib
+import cPickle
+import datetime
+import hashlib
+import importlib
+import json
 import os
 import re
 import shlex
 import time
-
-import jinja2
+import types
 
 from twisted.python import log
 from twisted.internet import defer
+from twisted.internet import task
+from twisted.internet import threads
 from twisted.internet import utils
 
-import zope.interface
-
-import buildbot.buildslave
-import buildbot.changes
-import buildbot.changes.p4poller
-import buildbot.changes.gitpoller
-import buildbot.config
-import buildbot.interfaces
-import buildbot.process.factory
-import buildbot.schedulers.basic
-import buildbot.schedulers.forcesched
-import buildbot.schedulers.timed
-import buildbot.schedulers.triggerable
-import buildbot.status.html
-import buildbot.status.mail
-import buildbot.status.web.auth
-import buildbot.status.web.authz
-import buildbot.status.words
-import buildbot.steps.shell
-import buildbot.steps.source.p4
-import buildbot.steps.source.git
-import buildbot.steps.python
-import buildbot.steps.trigger
-import buildbot.util
+# Imported on first build, by _import_buildbot
+buildbot = None
+
+def _import_buildbot():
+    ''' Imports buildbot modules used to build the config. Tools only creating
+        and inspecting scopes don't need them, and start much faster '''
+    #pylint: disable=global-statement,redefined-outer-name
+    global buildbot
+    if buildbot is not None:
+        return
+
+    import buildbot
+    import buildbot.buildslave
+    import buildbot.changes
+    import buildbot.changes.p4poller
+    import buildbot.changes.gitpoller
+    import buildbot.config
+    import buildbot.interfaces
+    import buildbot.locks
+    import buildbot.process.factory
+    import buildbot.process.properties
+    import buildbot.schedulers.basic
+    import buildbot.schedulers.forcesched
+    import buildbot.schedulers.timed
+    import buildbot.schedulers.triggerable
+    import buildbot.status.base
+    import buildbot.status.builder
+    import buildbot.status.html
+    import buildbot.status.mail
+    import buildbot.status.results
+    import buildbot.status.web.auth
+    import buildbot.status.web.authz
+    import buildbot.status.words
+    import buildbot.steps.shell
+    import buildbot.steps.source.p4
+    import buildbot.steps.source.git
+    import buildbot.steps.python
+    import buildbot.steps.trigger
+    import buildbot.util
+
+def _get_object(name):
+    ''' Returns the object with given dotted name, importing its module '''
+    module_name, object_name = name.rsplit('.', 1)
+    return getattr(importlib.import_module(module_name), object_name)
+
+class _LazyBase(object):
+    ''' Base of ebb classes deriving from a buildbot or twisted class, or
+        implementing a buildbot interface. As buildbot is imported on first
+        build, the actual class deriving from both is created with the first
+        instance.
+
+        The actual class derives from the declared one and has the same name,
+        so the name appears twice in the MRO, and type(SlaveSelector()) is not
+        SlaveSelector : use isinstance. Buildbot base attributes are only
+        found on instances. Subclass the declared class, never the type of an
+        instance, each declared subclass gets its own actual class.
+
+        Instances are pickled with their declared class, as the actual one
+        can't be found by name, so declared classes must be module level.
+        Unpickling creates the actual class again, and doesn't call
+        __init__ '''
+    # Dotted names of the buildbot base class and implemented interfaces
+    _lazy_base = None
+    _lazy_interfaces = []
+
+    def __new__(cls, *args, **kwargs):
+        #pylint: disable=unused-argument
+        if '_lazy_declared_class' not in cls.__dict__:
+            cls = _get_actual_class(cls)
+        return super(_LazyBase, cls).__new__(cls)
+
+    def __reduce_ex__(self, protocol):
+        # The actual class can't be found by name, the declared one is pickled
+        # instead, and creates it again when unpickled
+        reduced = list(super(_LazyBase, self).__reduce_ex__(2))
+        reduced[0] = _create_lazy_instance
+        reduced[1] = (self._lazy_declared_class,)
+        return tuple(reduced)
+
+def _create_lazy_instance(cls):
+    return cls.__new__(cls)
+
+def _get_actual_class(cls):
+    actual_class = cls.__dict__.get('_lazy_actual_class')
+    if actual_class is not None:
+        return actual_class
+
+    _import_buildbot()
+    import zope.interface
+
+    bases = (cls,)
+    if cls._lazy_base is not None:
+        bases += (_get_object(cls._lazy_base),)
+    actual_class = type(cls.__name__, bases, {
+        '__module__' : cls.__module__,
+        '_lazy_declared_class' : cls
+    })
+    for it in cls._lazy_interfaces:
+        zope.interface.classImplements(actual_class, _get_object(it))
+    cls._lazy_actual_class = actual_class
+    return actual_class
 
 class Scope(object):
     ''' Config node : inherit parent config values '''
@@ -244,6 +328,7 @@ class Scope(object):
 
     def build(self, config):
         ''' Builds this node '''
+        _import_buildbot()
         for child in self.children:
             child.build(config)
         self._build(config)
@@ -327,7 +412,7 @@ class Scope(object):
                 args.append(kwargs[name])
                 del kwargs[name]
 
-        return buildbot_class(*args, **kwargs)
+        return _create(buildbot_class, *args, **kwargs)
 
 class Private(Scope):
     ''' Defines not inherited values on the parent scope '''
@@ -351,6 +436,10 @@ class Config(Scope):
         self._triggerables = {}
         self._locks = {}
         self._builders_scopes = {}
+        self._builders_priorities = {}
+        self._nightly_schedulers = collections.OrderedDict()
+        self._change_schedulers = collections.OrderedDict()
+        self._scheduler_names = set()
         self.buildbot_config['builders'] = []
         self.buildbot_config['schedulers'] = []
         self.buildbot_config['slaves'] = []
@@ -428,6 +517,34 @@ class Config(Scope):
         Scope.set_checked('web_status_user', user, str)
         Scope.set_checked('web_status_password', password, str)
 
+    @staticmethod
+    def nightly_stagger(batch_size, minutes=1):
+        ''' Splits nightly schedulers of more than batch_size builders, each
+            batch starting given minutes after the previous one '''
+        Scope.set_checked('nightly_stagger_batch_size', batch_size, int)
+        Scope.set_checked('nightly_stagger_minutes', minutes, int)
+
+    @staticmethod
+    def event_exporter(sink,
+                       flush_interval=None,
+                       batch_size=None,
+                       max_buffered=None):
+        ''' Exports build and step start and finish events to sink as they
+            happen. sink has a write(documents) method, like NdjsonEventSink
+            and ElasticsearchEventSink '''
+        Scope.set_checked('event_exporter_sink', sink, None)
+        Scope.set_checked('event_exporter_flush_interval',
+                          flush_interval,
+                          (int, float))
+        Scope.set_checked('event_exporter_batch_size', batch_size, int)
+        Scope.set_checked('event_exporter_max_buffered', max_buffered, int)
+
+    @staticmethod
+    def metrics(port):
+        ''' Serves metrics of ebb callbacks on given port, in the Prometheus
+            text format '''
+        Scope.set_checked('metrics_port', port, int)
+
     @staticmethod
     def add_renderer_handlers(*handlers):
         ''' Add rendering handlers that can udpate rendering arguments at build
@@ -445,11 +562,65 @@ class Config(Scope):
                 return slave
         return None
 
-    def build_config(self):
-        ''' Builds the buildbot config '''
-        self.build(self)
+    def build_config(self, snapshot_path=None, snapshot_sources=None,
+                     snapshot_key=None):
+        ''' Builds the buildbot config. If snapshot_path is set, saves how
+            buildbot objects were created there, so that load_config_snapshot
+            can recreate them without building the config again, as long as
+            snapshot_sources files and the snapshot_key string don't
+            change '''
+        if snapshot_path is None:
+            self.build(self)
+            return self.buildbot_config
+
+        #pylint: disable=global-statement
+        global _SNAPSHOT
+        _SNAPSHOT = _ConfigSnapshot()
+        try:
+            self.build(self)
+            _SNAPSHOT.save(snapshot_path,
+                           _get_snapshot_key(snapshot_sources or [],
+                                             snapshot_key),
+                           self.buildbot_config)
+        finally:
+            _SNAPSHOT = None
         return self.buildbot_config
 
+    def get_lock(self, name, mode, max_count, per_slave):
+        ''' Returns an access to the lock with given name, created the first
+            time it's requested '''
+        assert mode in ['exclusive', 'counting']
+        if per_slave:
+            lock_class = buildbot.locks.SlaveLock
+        else:
+            lock_class = buildbot.locks.MasterLock
+
+        if name not in self._locks:
+            self._locks[name] = _create(lock_class, name, maxCount=max_count)
+        lock = self._locks[name]
+        assert isinstance(lock, lock_class) and lock.maxCount == max_count, \
+               'Lock %s declared with different settings' % name
+        return lock.access(mode)
+
+    def add_nightly_builder(self, builder_name, scheduler_args):
+        ''' Schedules a builder nightly, in the same scheduler as builders
+            with identical scheduler arguments '''
+        key = _get_hashable(scheduler_args)
+        if key not in self._nightly_schedulers:
+            self._nightly_schedulers[key] = (scheduler_args, [])
+        self._nightly_schedulers[key][1].append(builder_name)
+
+    def add_change_builder(self, builder_name, project, accept_regex,
+                           reject_regex, filter_args, scheduler_args):
+        ''' Triggers a builder on changes, in the same scheduler as builders
+            with identical change filter and scheduler arguments '''
+        args = ((project, accept_regex, reject_regex), filter_args,
+                scheduler_args)
+        key = _get_hashable(args)
+        if key not in self._change_schedulers:
+            self._change_schedulers[key] = (args, [])
+        self._change_schedulers[key][1].append(builder_name)
+
     def add_slave(self, slave):
         ''' Adds a slave for later tag filtering '''
         self._slaves.append(slave)
@@ -457,6 +628,11 @@ class Config(Scope):
     def add_builder(self, builder, scope):
         ''' Adds a builder to this config '''
         self._builders_scopes[builder.name] = scope
+        self._builders_priorities[builder.name] = (
+            scope.get('_builder_priority', 0),
+            scope.get('_builder_priority_aging', 0),
+            scope.get_interpolated('builder_category'),
+            scope.get('_builder_fair_share'))
         self.buildbot_config['builders'].append(builder)
 
     def get_slave_list(self, *tags):
@@ -501,6 +677,14 @@ class Config(Scope):
 
         conf_dict.update(self._get_prefixed_properties('base'))
         self._add_web_status()
+        self._add_change_schedulers()
+        self._add_nightly_schedulers()
+        self._add_event_exporter()
+        self._add_metrics()
+
+        # SlaveSelector learns from build events
+        if isinstance(self.next_slave_selector, SlaveSelector):
+            self.buildbot_config['status'].append(self.next_slave_selector)
 
     def _add_web_status(self):
         http_port = self.get('web_status_port')
@@ -509,30 +693,303 @@ class Config(Scope):
 
         users = [(self.get_interpolated('web_status_user'),
                   self.get_interpolated('web_status_password'))]
-        auth = buildbot.status.web.auth.BasicAuth(users)
-        authz = buildbot.status.web.authz.Authz(auth=auth,
-                                                view=True,
-                                                gracefulShutdown='auth',
-                                                forceBuild='auth',
-                                                forceAllBuilds='auth',
-                                                pingBuilder='auth',
-                                                stopBuild='auth',
-                                                stopAllBuilds='auth',
-                                                cancelPendingBuild='auth',
-                                                showUsersPage='auth',
-                                                cleanShutdown='auth')
-        web_status = buildbot.status.html.WebStatus(http_port=http_port,
-                                                    authz=authz)
+        auth = _create(buildbot.status.web.auth.BasicAuth, users)
+        authz = _create(buildbot.status.web.authz.Authz,
+                        auth=auth,
+                        view=True,
+                        gracefulShutdown='auth',
+                        forceBuild='auth',
+                        forceAllBuilds='auth',
+                        pingBuilder='auth',
+                        stopBuild='auth',
+                        stopAllBuilds='auth',
+                        cancelPendingBuild='auth',
+                        showUsersPage='auth',
+                        cleanShutdown='auth')
+        web_status = _create(buildbot.status.html.WebStatus,
+                             http_port=http_port,
+                             authz=authz)
         self.buildbot_config['status'].append(web_status)
 
-    def _prioritize_builders(self, _, builders):
-        def _get_priority(builder):
-            try:
-                return self._builders_scopes[builder.name].get('_builder_priority', 0)
-            except KeyError:
-                return 99999
-        builders.sort(key=_get_priority, reverse=True)
-        return builders
+    def _add_change_schedulers(self):
+        for all_args, builder_names in self._change_schedulers.itervalues():
+            filter_fn_args, filter_args, scheduler_args = all_args
+            builder_names = sorted(builder_names)
+            name = self._get_scheduler_name('single branch', all_args)
+
+            args = dict(filter_args)
+            args['filter_fn'] = _ChangeFilter(name, *filter_fn_args)
+            change_filter = _create(buildbot.changes.filter.ChangeFilter, **args)
+
+            args = dict(scheduler_args)
+            args.update({'name' : name,
+                         'builderNames' : builder_names,
+                         'change_filter' : change_filter,
+                         'reason' : 'A CL Triggered this build'})
+            scheduler_class = buildbot.schedulers.basic.SingleBranchScheduler
+            scheduler = _create(scheduler_class, **args)
+            self.buildbot_config['schedulers'].append(scheduler)
+
+    def _add_nightly_schedulers(self):
+        batch_size = self.get('nightly_stagger_batch_size')
+        stagger_minutes = self.get('nightly_stagger_minutes', 1)
+        for scheduler_args, builder_names in self._nightly_schedulers.itervalues():
+            builder_names = sorted(builder_names)
+            group_batch_size = batch_size or len(builder_names)
+            for start in range(0, len(builder_names), group_batch_size):
+                batch_index = start // group_batch_size
+                args = dict(scheduler_args)
+                args['builderNames'] = builder_names[start:start + group_batch_size]
+                args['name'] = self._get_scheduler_name('nightly',
+                                                        scheduler_args,
+                                                        batch_index)
+                if batch_index > 0:
+                    _delay_nightly_args(args, batch_index * stagger_minutes)
+
+                scheduler = _create(buildbot.schedulers.timed.Nightly, **args)
+                self.buildbot_config['schedulers'].append(scheduler)
+
+    def _get_scheduler_name(self, scheduler_type, scheduler_args, batch_index=0):
+        ''' Names a scheduler shared by builders after its arguments and
+            batch, so that it keeps its state when builders are added or
+            removed '''
+        name = '%s scheduler %s' % (scheduler_type,
+                                    _get_args_digest(scheduler_args))
+        if batch_index > 0:
+            name += ' batch %s' % batch_index
+        # Arguments only differing by objects of the same type have the same
+        # digest
+        unique_name, index = name, 1
+        while unique_name in self._scheduler_names:
+            index += 1
+            unique_name = '%s (%s)' % (name, index)
+        self._scheduler_names.add(unique_name)
+        return unique_name
+
+    def _add_event_exporter(self):
+        if self.get('event_exporter_sink') is None:
+            return
+
+        exporter = self._build_class(_BuildEventExporter,
+                                     'event_exporter',
+                                     raw=['event_exporter_sink'])
+        self.buildbot_config['status'].append(exporter)
+
+    def _add_metrics(self):
+        port = self.get('metrics_port')
+        if port is None:
+            return
+
+        self.buildbot_config['status'].append(_create(_MetricsStatus, port))
+
+    @defer.inlineCallbacks
+    def _prioritize_builders(self, buildmaster, builders):
+        ''' Sorts builders by priority, raised by the age of their oldest
+            pending request. Builders of a category running more than its fair
+            share of builds go after the others '''
+        unknown_builder = (99999, 0, None, None)
+        priorities = [self._builders_priorities.get(it.name, unknown_builder)
+                      for it in builders]
+
+        # Request ages come from the database, only get them when needed
+        oldest_times = yield defer.gatherResults([
+            defer.maybeDeferred(builder.getOldestRequestTime) if aging else
+            defer.succeed(None)
+            for builder, (_, aging, _, _) in zip(builders, priorities)])
+
+        # Only the sort is timed, not the database queries above
+        start = _METRICS.start_timer()
+
+        # Builders given here only are those with pending requests, running
+        # builds of a category are counted on all of its builders
+        shares = {}
+        running_builds = collections.Counter()
+        for builder in buildmaster.botmaster.builders.itervalues():
+            _, _, category, share = self._builders_priorities.get(
+                builder.name, unknown_builder)
+            if share is not None:
+                shares[category] = share
+                running_builds[category] += len(builder.building)
+        total_share = sum(shares.itervalues())
+        total_running_builds = sum(running_builds.itervalues())
+
+        now = time.time()
+        def _get_rank(index):
+            priority, aging, category, share = priorities[index]
+            oldest_time = oldest_times[index]
+            if oldest_time is not None:
+                if isinstance(oldest_time, datetime.datetime):
+                    oldest_time = buildbot.util.datetime2epoch(oldest_time)
+                priority += aging * (now - oldest_time) / 60.0
+
+            over_share = (share is not None and
+                          running_builds[category] * total_share >
+                          share * total_running_builds)
+            return (over_share, -priority)
+
+        order = sorted(range(len(builders)), key=_get_rank)
+        _METRICS.observe_duration('ebb_prioritize_builders_seconds', start)
+        defer.returnValue([builders[it] for it in order])
+
+# Only set while Config.build_config saves a snapshot
+_SNAPSHOT = None
+
+_SNAPSHOT_VERSION = 1
+
+# Resolved on import, masters change directory before loading their config.
+# __file__ can be the compiled module
+_SOURCE_PATH = os.path.abspath(os.path.splitext(__file__)[0] + '.py')
+
+def _create(cls, *args, **kwargs):
+    ''' Creates a buildbot object, recording the call if a snapshot is being
+        saved, as live objects like services can't be pickled, but the calls
+        that created them can be replayed '''
+    result = cls(*args, **kwargs)
+    if _SNAPSHOT is not None:
+        _SNAPSHOT.record(result, cls, args, kwargs)
+    return result
+
+class _ConfigSnapshot(object):
+    ''' Calls creating buildbot objects, saved with the config using them '''
+    def __init__(self):
+        self._calls = []
+        self._indices = {}
+
+    def record(self, result, cls, args, kwargs):
+        ''' Records a call creating result '''
+        # Results are kept in the call list, so that their ids stay unique
+        self._indices[id(result)] = len(self._calls)
+        self._calls.append((result, cls, args, kwargs))
+
+    def save(self, path, key, buildbot_config):
+        ''' Saves the calls and the buildbot config to path. Logs and removes the
+            snapshot if something can't be pickled '''
+        # Attributes set by __new__ are shared with the config, like the
+        # factories of buildbot steps, and are set again when calls are loaded
+        attributes = {}
+        for index, (result, cls, args, kwargs) in enumerate(self._calls):
+            if not isinstance(cls, types.ClassType):
+                allocated = cls.__new__(cls, *args, **kwargs)
+                for name in getattr(allocated, '__dict__', {}):
+                    attributes[id(getattr(result, name))] = (index, name)
+
+        def _persistent_id(value):
+            index = self._indices.get(id(value))
+            if index is not None and self._calls[index][0] is value:
+                return ('call', index)
+            if id(value) in attributes:
+                index, name = attributes[id(value)]
+                if getattr(self._calls[index][0], name) is value:
+                    return ('attribute', index, name)
+            if isinstance(value, types.MethodType) and value.im_self is not None:
+                return ('method', value.im_self, value.__name__)
+            return None
+
+        temp_path = path + '.tmp'
+        try:
+            with open(temp_path, 'wb') as snapshot_file:
+                pickler = cPickle.Pickler(snapshot_file, cPickle.HIGHEST_PROTOCOL)
+                pickler.persistent_id = _persistent_id
+                classes = [it[1] for it in self._calls]
+                pickler.dump((_SNAPSHOT_VERSION, key, classes))
+                # The pickler memo is kept between dumps, so objects shared by
+                # calls and the config are saved once
+                for _, _, args, kwargs in self._calls:
+                    pickler.dump((args, kwargs))
+                pickler.dump(buildbot_config)
+            os.rename(temp_path, path)
+        #pylint: disable=broad-except
+        except Exception as error:
+            log.msg('ebb: unable to save config snapshot %s : %s' % (path, error))
+            for it in [temp_path, path]:
+                if os.path.exists(it):
+                    os.remove(it)
+
+def _allocate(cls):
+    if isinstance(cls, types.ClassType):
+        return types.InstanceType(cls)
+    return cls.__new__(cls)
+
+def _initialize(value, cls, args, kwargs):
+    ''' Initializes an object allocated before its call was loaded '''
+    if not isinstance(cls, types.ClassType):
+        # Some classes set attributes in __new__, like buildbot steps
+        allocated = cls.__new__(cls, *args, **kwargs)
+        value.__dict__.update(getattr(allocated, '__dict__', {}))
+    value.__init__(*args, **kwargs)
+
+def _get_snapshot_key(sources, extra_key):
+    key = hashlib.sha1()
+    key.update(str(_SNAPSHOT_VERSION))
+    key.update(buildbot.version)
+    for path in [_SOURCE_PATH] + list(sources):
+        with open(path, 'rb') as source_file:
+            key.update(path)
+            key.update(source_file.read())
+    if extra_key is not None:
+        assert isinstance(extra_key, basestring)
+        key.update(extra_key)
+    return key.hexdigest()
+
+def load_config_snapshot(path, sources, key=None):
+    ''' Returns the buildbot config saved by Config.build_config in path, or
+        None if there is no snapshot, or if ebb, buildbot, sources files or
+        key changed since it was saved. Use it to skip building the config
+        tree when the master starts :
+
+        BuildmasterConfig = ebb.load_config_snapshot(path, [__file__])
+        if BuildmasterConfig is None:
+            with ebb.Config() as config:
+                ...
+            BuildmasterConfig = config.build_config(path, [__file__])
+
+        key is a string for anything else the config depends on, like
+        environment variables or files read by master.cfg '''
+    if not os.path.exists(path):
+        return None
+
+    try:
+        _import_buildbot()
+        with open(path, 'rb') as snapshot_file:
+            classes = []
+            objects = {}
+            def _persistent_load(pid):
+                if pid[0] == 'call':
+                    index = pid[1]
+                    if index not in objects:
+                        # Arguments can reference objects created later, like
+                        # renderers referencing the whole scope tree. Those
+                        # are allocated now, and initialized with their call
+                        objects[index] = _allocate(classes[index])
+                    return objects[index]
+                if pid[0] == 'attribute':
+                    return getattr(objects[pid[1]], pid[2])
+                if pid[0] == 'method':
+                    return getattr(pid[1], pid[2])
+                raise cPickle.UnpicklingError('Unknown snapshot id %s' % (pid,))
+
+            unpickler = cPickle.Unpickler(snapshot_file)
+            unpickler.persistent_load = _persistent_load
+            version, saved_key, snapshot_classes = unpickler.load()
+            if (version != _SNAPSHOT_VERSION or
+                    saved_key != _get_snapshot_key(sources, key)):
+                log.msg('ebb: config snapshot %s is outdated' % path)
+                return None
+
+            classes.extend(snapshot_classes)
+            for index, cls in enumerate(classes):
+                args, kwargs = unpickler.load()
+                if index in objects:
+                    _initialize(objects[index], cls, args, kwargs)
+                else:
+                    objects[index] = cls(*args, **kwargs)
+            buildbot_config = unpickler.load()
+    #pylint: disable=broad-except
+    except Exception as error:
+        log.msg('ebb: unable to load config snapshot %s : %s' % (path, error))
+        return None
+
+    return buildbot_config
 
 class Slave(Scope):
     ''' Creates a new buildbot slave '''
@@ -580,7 +1037,7 @@ class Builder(Scope):
         super(Builder, self).__init__()
         self._accept_regex = None
         self._reject_regex = None
-        self._factory = buildbot.process.factory.BuildFactory()
+        self._steps = []
         self._nightly = None
 
         self.properties['builder_name'] = name
@@ -591,7 +1048,7 @@ class Builder(Scope):
 
     def add_step(self, step):
         ''' Adds a step to this builder '''
-        self._factory.addStep(step)
+        self._steps.append(step)
 
     def trigger_on_change(self, accept_regex='.*', reject_regex=None):
         ''' Triggers this build on change from source control '''
@@ -624,8 +1081,25 @@ class Builder(Scope):
                tree_stable_timer=None,
                file_is_important=None,
                project=None,
-               priority=None):
-        ''' Sets builder config values '''
+               priority=None,
+               priority_aging=None,
+               fair_share=None,
+               merge_max_changes=None):
+        ''' Sets builder config values. merge_requests can be the name of a
+            built-in strategy :
+            - 'branch' merges all requests on the same branch
+            - 'newest_revision' also merges requests on the same branch, except
+              those forced on a given revision
+            - 'max_changes' merges like 'newest_revision', up to
+              merge_max_changes changes per build
+            priority_aging is added to priority for each minute the oldest
+            pending request of a builder waited. It keeps high priority
+            builders from waiting behind a burst of requests, but when slaves
+            are overloaded for long, it serves requests in about submission
+            order, and low priority builders wait as long as the backlog :
+            give them a fair_share. fair_share is the share of running builds
+            of the builder category, relative to those of other categories
+            with a fair share '''
         Scope.set_checked('builder_name', name, basestring)
         Scope.set_checked('builder_category', category, basestring)
         Scope.set_checked('builder_builddir', build_dir, None)
@@ -638,6 +1112,11 @@ class Builder(Scope):
         Scope.set_checked('scheduler_fileIsImportant', file_is_important, None)
         Scope.set_checked('change_filter_project', project, basestring)
         Scope.set_checked('_builder_priority', priority, int)
+        Scope.set_checked('_builder_priority_aging',
+                          priority_aging,
+                          (int, float))
+        Scope.set_checked('_builder_fair_share', fair_share, (int, float))
+        Scope.set_checked('_builder_merge_max_changes', merge_max_changes, int)
 
     @staticmethod
     def mail_config(from_address=None,
@@ -699,6 +1178,15 @@ class Builder(Scope):
         ''' Adds a property to builders in scope '''
         Scope.update('builder_properties', name, value)
 
+    @staticmethod
+    def add_lock(name, mode='exclusive', max_count=1, per_slave=True):
+        ''' Makes builds of builders in scope hold the lock with given name.
+            Locks with the same name are shared, at most max_count builds
+            hold a 'counting' one, on each slave if per_slave is True.
+            Builders declared in a builder, triggered by it, don't inherit
+            its locks '''
+        Scope.update('_builder_locks', name, (mode, max_count, per_slave))
+
     def _build(self, config):
         if config.slave_list_selector:
             slavenames = config.slave_list_selector(self)
@@ -706,12 +1194,20 @@ class Builder(Scope):
             slave_tags = self.get_interpolated('_builder_slave_tags', [])
             slavenames = config.get_slave_list(*slave_tags)
 
-        # TODO locks = get_locks('job', config, scope)
         args = {
             'slavenames': slavenames,
             'nextSlave': config.next_slave_selector,
-            'factory': self._factory,
+            'factory': buildbot.process.factory.BuildFactory(self._steps),
         }
+        locks = _get_locks(config, self, '_builder_locks')
+        if locks:
+            args['locks'] = locks
+
+        merge_requests = self.get('builder_mergeRequests')
+        if isinstance(merge_requests, basestring):
+            max_changes = self.get('_builder_merge_max_changes', 10)
+            args['mergeRequests'] = _get_request_merger(merge_requests,
+                                                        max_changes)
 
         builder = self._build_class(buildbot.config.BuilderConfig, 'builder', additional=args)
 
@@ -729,46 +1225,28 @@ class Builder(Scope):
         if self._accept_regex is None:
             return
 
-        builder_name = self.get_interpolated('builder_name')
-        project_name = self.get_interpolated('project_name')
-
-        args = {
-            'filter_fn': _ChangeFilter(builder_name, project_name,
-                                       self.interpolate(self._accept_regex),
-                                       self.interpolate(self._reject_regex))
-        }
-
-        change_filter = self._build_class(buildbot.changes.filter.ChangeFilter,
-                                          'change_filter',
-                                          additional=args)
-
-        args = {'name' : '%s single branch scheduler' % builder_name,
-                'builderNames' : [builder_name],
-                'change_filter' : change_filter,
-                'reason' : 'A CL Triggered this build'}
-
-        scheduler_class = buildbot.schedulers.basic.SingleBranchScheduler
-        scheduler = self._build_class(scheduler_class,
-                                      ('scheduler', 'branch_scheduler'),
-                                      additional=args)
-        config.buildbot_config['schedulers'].append(scheduler)
+        # Config creates one change filter and scheduler for builders with
+        # the same arguments
+        scheduler_args = self._get_prefixed_properties(('scheduler',
+                                                        'branch_scheduler'))
+        config.add_change_builder(self.get_interpolated('builder_name'),
+                                  self.get_interpolated('project_name'),
+                                  self.interpolate(self._accept_regex),
+                                  self.interpolate(self._reject_regex),
+                                  self._get_prefixed_properties('change_filter'),
+                                  scheduler_args)
 
     def _add_nightly_scheduler(self, config):
         if self._nightly is None:
             return
-        builder_name = self.get_interpolated('builder_name')
-        args = {'name' : '%s nightly scheduler' % builder_name,
-                'builderNames' : [builder_name],
-                'branch' : None} #We don't use branches the way buildbot expects it
+        args = self._get_prefixed_properties('scheduler')
+        args['branch'] = None #We don't use branches the way buildbot expects it
         for key, value in self._nightly.iteritems():
             if value is not None:
                 args[key] = value
 
-        scheduler_class = buildbot.schedulers.timed.Nightly
-        scheduler = self._build_class(scheduler_class,
-                                      'scheduler',
-                                      additional=args)
-        config.buildbot_config['schedulers'].append(scheduler)
+        # Config creates one scheduler for builders with the same schedule
+        config.add_nightly_builder(self.get_interpolated('builder_name'), args)
 
     def _add_mail_status(self, config):
         extra_recipients = self.get_interpolated('mail_extraRecipients')
@@ -827,20 +1305,44 @@ class Repository(Scope):
 
             config.buildbot_config['change_source'].append(change_source)
 
-class P4StreamSource(buildbot.changes.p4poller.P4Source):
-    def __init__(self, **args):
+class P4StreamSource(_LazyBase):
+    ''' P4 poller handling streams, and describing new changes in batches '''
+    _lazy_base = 'buildbot.changes.p4poller.P4Source'
+
+    def __init__(self, describe_batch_size=50, **args):
         self._stream = None
+        self._describe_batch_size = describe_batch_size
+        self._pending_changes = []
+        self._descriptions = {}
         super(P4StreamSource, self).__init__(**args)
 
+    @defer.inlineCallbacks
+    def _poll(self):
+        start = _METRICS.start_timer()
+        try:
+            yield super(P4StreamSource, self)._poll()
+        finally:
+            _METRICS.observe_duration('ebb_p4_poll_seconds',
+                                      start,
+                                      location=self._stream or self.p4base)
+
     @defer.inlineCallbacks
     #pylint: disable=invalid-name,missing-docstring
     def _get_process_output(self, args):
-        base_get_process_output = super(P4StreamSource, self)._get_process_output
-
-        # If action is not 'p4 changes', use the original function
-        if 'changes' not in args:
+        if 'describe' in args:
+            tmp = yield self._get_describe_output(args)
+        elif 'changes' in args:
+            tmp = yield self._get_changes_output(args)
+            self._pending_changes = self._parse_changes(tmp)
+            self._descriptions = {}
+        else:
+            base_get_process_output = super(P4StreamSource, self)._get_process_output
             tmp = yield base_get_process_output(args)
-            defer.returnValue(tmp)
+        defer.returnValue(tmp)
+
+    @defer.inlineCallbacks
+    def _get_changes_output(self, args):
+        base_get_process_output = super(P4StreamSource, self)._get_process_output
 
         # Last argument is the location we're polling
         location, suffix = args[-1], ""
@@ -879,6 +1381,54 @@ class P4StreamSource(buildbot.changes.p4poller.P4Source):
         tmp = yield base_get_process_output(['-c', client] + args[:-1] + ['//%s%s' % (client, suffix)])
         defer.returnValue(tmp)
 
+    @defer.inlineCallbacks
+    def _get_describe_output(self, args):
+        base_get_process_output = super(P4StreamSource, self)._get_process_output
+
+        # The base poller describes changes one by one, oldest first : on the
+        # first miss, describe this change and the next pending ones at once.
+        change = args[-1]
+        if change not in self._descriptions:
+            batch = self._get_describe_batch(change)
+            argc = args.index('describe')
+            batch_args = args[:argc] + ['describe', '-s'] + batch
+            try:
+                tmp = yield base_get_process_output(batch_args)
+            #pylint: disable=broad-except
+            except Exception as ex:
+                # A single faulty change fails the whole batch, fallback to
+                # describing changes one by one
+                log.msg('P4StreamSource: batched describe of %s failed : %s' % (' '.join(batch), ex))
+                self._pending_changes = []
+                tmp = yield base_get_process_output(args)
+                defer.returnValue(tmp)
+
+            for number, description in _split_p4_describe(tmp):
+                self._descriptions[number] = description
+
+        if change not in self._descriptions:
+            tmp = yield base_get_process_output(args)
+            defer.returnValue(tmp)
+
+        defer.returnValue(self._descriptions.pop(change))
+
+    def _get_describe_batch(self, change):
+        if change not in self._pending_changes:
+            return [change]
+        start = self._pending_changes.index(change)
+        end = start + max(1, self._describe_batch_size)
+        return self._pending_changes[start:end]
+
+    def _parse_changes(self, output):
+        changes = []
+        for line in output.split('\n'):
+            match = self.changes_line_re.match(line.strip())
+            if match:
+                changes.append(match.group('num'))
+        # p4 changes lists newest changes first
+        changes.reverse()
+        return changes
+
 class P4Repository(Repository):
     ''' P4Repository handling '''
     def __init__(self, name, is_polling_enabled):
@@ -886,7 +1436,8 @@ class P4Repository(Repository):
 
     @staticmethod
     def config(port=None, user=None, password=None, client=None,
-               binary=None, encoding=None, timezone=None, spec_options=None):
+               binary=None, encoding=None, timezone=None, spec_options=None,
+               describe_batch_size=None):
         ''' Common global p4 parameters '''
         # TODO : Add ticket management
         Scope.set_checked('p4_common_p4port', port, str)
@@ -897,6 +1448,7 @@ class P4Repository(Repository):
         Scope.set_checked('p4_poll_p4bin', binary, str)
         Scope.set_checked('p4_poll_encoding', encoding, str)
         Scope.set_checked('p4_poll_server_tz', timezone, None)
+        Scope.set_checked('p4_poll_describe_batch_size', describe_batch_size, int)
 
     @staticmethod
     def add_views(*views):
@@ -930,8 +1482,7 @@ class P4Repository(Repository):
                 paths_to_poll.append(base)
 
         for base in paths_to_poll:
-            split_file = lambda branchfile: (None, branchfile)
-            args['split_file'] = split_file
+            args['split_file'] = _split_depot_file
             args['p4base'] = '//' + base
             project_name = self.get_interpolated('project_name')
             if project_name is not None:
@@ -942,6 +1493,69 @@ class P4Repository(Repository):
                                    additional=args)
             yield p4
 
+def _split_depot_file(branchfile):
+    return (None, branchfile)
+
+class GitLsRemotePoller(_LazyBase):
+    ''' Git poller that can skip fetching when remote refs didn't change '''
+    _lazy_base = 'buildbot.changes.gitpoller.GitPoller'
+
+    # Added to GitPoller ones, so that toggling the check reconfigures it
+    compare_attrs = ['_ls_remote_check']
+
+    def __init__(self, ls_remote_check=False, **args):
+        self._ls_remote_check = ls_remote_check
+        self._remote_refs = None
+        super(GitLsRemotePoller, self).__init__(**args)
+
+    @defer.inlineCallbacks
+    #pylint: disable=invalid-name,missing-docstring
+    def poll(self):
+        refs = None
+        if self._ls_remote_check:
+            refs = yield self._get_remote_refs()
+
+        if refs is not None:
+            if self._remote_refs is None:
+                self._remote_refs = yield self.getState('lastRemoteRefs', {})
+            if refs == self._remote_refs:
+                log.msg('GitLsRemotePoller: no ref changed on %s, skipping fetch' % self.repourl)
+                return
+
+        yield super(GitLsRemotePoller, self).poll()
+
+        # Only remember refs once the fetch succeeded, so that a failed poll is
+        # retried next time
+        if refs is not None:
+            self._remote_refs = refs
+            yield self.setState('lastRemoteRefs', refs)
+
+    @defer.inlineCallbacks
+    def _get_remote_refs(self):
+        # Polling all branches needs a full fetch anyway
+        if not isinstance(self.branches, list):
+            defer.returnValue(None)
+
+        patterns = []
+        for branch in self.branches:
+            if not branch.startswith('refs/'):
+                branch = 'refs/heads/%s' % branch
+            patterns.append(branch)
+
+        try:
+            output = yield self._dovccmd('ls-remote', [self.repourl] + patterns)
+        #pylint: disable=broad-except
+        except Exception as ex:
+            log.msg('GitLsRemotePoller: ls-remote failed on %s : %s' % (self.repourl, ex))
+            defer.returnValue(None)
+
+        refs = {}
+        for line in output.split('\n'):
+            fields = line.strip().split('\t')
+            if len(fields) == 2:
+                refs[fields[1]] = fields[0]
+        defer.returnValue(refs)
+
 class GitRepository(Repository):
     ''' Git repository '''
     def __init__(self, name, repo_url, is_polling_enabled):
@@ -958,7 +1572,8 @@ class GitRepository(Repository):
                progress=None,
                retry_fetch=None,
                clobber_on_failure=None,
-               method=None):
+               method=None,
+               ls_remote_check=None):
         ''' Common global git parameters '''
         Scope.set_checked('git_poll_gitbin', git_bin, str)
         Scope.set_checked('get_poll_usetimestamps', use_time_stamps, bool)
@@ -970,6 +1585,7 @@ class GitRepository(Repository):
         Scope.set_checked('git_sync_retryFetch', retry_fetch, bool)
         Scope.set_checked('git_sync_clobberOnFailure', clobber_on_failure, bool)
         Scope.set_checked('git_sync_method', method, str)
+        Scope.set_checked('git_poll_ls_remote_check', ls_remote_check, bool)
         assert method in [None, 'clobber', 'fresh', 'clean', 'copy']
 
     def get_sync_step(self, _, step_args):
@@ -982,7 +1598,7 @@ class GitRepository(Repository):
         project_name = self.get_interpolated('project_name')
         if project_name is not None:
             args['project'] = project_name
-        yield self._build_class(buildbot.changes.gitpoller.GitPoller,
+        yield self._build_class(GitLsRemotePoller,
                                 ('git_common', 'git_poll'),
                                 additional=args)
 class Step(Scope):
@@ -1021,6 +1637,12 @@ class Step(Scope):
         Scope.set_checked('step_workdir', workdir, str)
         Scope.set_checked('step_timeout', timeout, int)
 
+    @staticmethod
+    def add_lock(name, mode='exclusive', max_count=1, per_slave=True):
+        ''' Makes steps in scope hold the lock with given name, see
+            Builder.add_lock '''
+        Scope.update('_step_locks', name, (mode, max_count, per_slave))
+
     @abc.abstractmethod
     def _get_step(self, config, step_args):
         ''' Builds the buildbot step '''
@@ -1034,6 +1656,9 @@ class Step(Scope):
             raise Exception(msg)
 
         step_args = self._get_prefixed_properties('step')
+        locks = _get_locks(config, self, '_step_locks')
+        if locks:
+            step_args['locks'] = locks
         builder.add_step(self._get_step(config, step_args))
 
 class Sync(Step):
@@ -1086,15 +1711,10 @@ class Command(Step):
     def set_decode_rc(return_value, meaning):
         ''' Adds a return code meaning to this command '''
         assert isinstance(return_value, int)
-        buildbot_enum = {'success' : buildbot.status.results.SUCCESS,
-                         'warnings' : buildbot.status.results.WARNINGS,
-                         'error' : buildbot.status.results.FAILURE}
-
-        assert meaning in buildbot_enum
-
-        Scope.update('shell_command_decodeRC',
-                     return_value,
-                     buildbot_enum[meaning])
+        assert meaning in ['success', 'warnings', 'error']
+        # Converted to buildbot results when building, buildbot isn't
+        # imported yet
+        Scope.update('_command_decode_rc', return_value, meaning)
 
     @staticmethod
     def set_log_file(name, path):
@@ -1103,6 +1723,14 @@ class Command(Step):
 
     def _get_step(self, config, step_args):
         step_args['command'] = self.render(self._command)
+        decode_rc = self.get('_command_decode_rc')
+        if decode_rc is not None:
+            buildbot_enum = {'success' : buildbot.status.results.SUCCESS,
+                             'warnings' : buildbot.status.results.WARNINGS,
+                             'error' : buildbot.status.results.FAILURE}
+            step_args['decodeRC'] = dict((return_value, buildbot_enum[meaning])
+                                         for return_value, meaning
+                                         in decode_rc.iteritems())
         return self._build_class(buildbot.steps.shell.ShellCommand,
                                  'shell_command',
                                  rendered=['shell_command_logfiles'],
@@ -1147,6 +1775,160 @@ class Sphinx(Step):
                                  additional=step_args)
 
 
+def _get_hashable(value):
+    ''' Returns a key equal for equal scheduler arguments '''
+    if isinstance(value, dict):
+        return tuple(sorted((key, _get_hashable(it))
+                            for key, it in value.iteritems()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_get_hashable(it) for it in value)
+    try:
+        hash(value)
+        return value
+    except TypeError:
+        return ('id', id(value))
+
+def _get_args_digest(args):
+    ''' Returns a digest of scheduler arguments, stable across master
+        restarts '''
+    def _get_stable(value):
+        if isinstance(value, dict):
+            return sorted((key, _get_stable(it))
+                          for key, it in value.iteritems())
+        if isinstance(value, (list, tuple)):
+            return [_get_stable(it) for it in value]
+        if isinstance(value, (basestring, int, long, float, types.NoneType)):
+            return value
+        # Object reprs usually contain their address
+        return getattr(value, '__name__', type(value).__name__)
+    return hashlib.sha1(repr(_get_stable(args))).hexdigest()[:8]
+
+def _delay_nightly_args(args, minutes):
+    ''' Delays a Nightly schedule by given minutes. Schedules whose delayed
+        minute can't carry into their hour, or their hour into their days,
+        are left unchanged '''
+    minute = args.get('minute', 0)
+    if not isinstance(minute, int):
+        return
+
+    minute += minutes
+    if minute >= 60:
+        hour = args.get('hour', '*')
+        days = [args.get(it, '*') for it in ['dayOfMonth', 'month', 'dayOfWeek']]
+        if (not isinstance(hour, int) or
+                (hour + minute // 60 >= 24 and days != ['*'] * 3)):
+            log.msg('Not staggering scheduler %s, its delay would change its '
+                    'hours or days' % args['name'])
+            return
+        args['hour'] = (hour + minute // 60) % 24
+    args['minute'] = minute % 60
+
+def _get_locks(config, scope, property_name):
+    builder = scope
+    if not isinstance(builder, Builder):
+        builder = scope.get_parent_of_type(Builder)
+    trigger = builder.get_parent_of_type((Builder, Step))
+    if trigger is None:
+        locks = scope.get(property_name, {})
+    else:
+        locks = _get_triggered_locks(scope, property_name, trigger)
+
+    return [config.get_lock(name, *settings)
+            for name, settings in sorted(locks.iteritems())]
+
+def _get_triggered_locks(scope, property_name, trigger):
+    ''' Builders declared in a builder are triggered by it, and don't inherit
+        its locks : the triggering build holds them while it waits, so the
+        triggered one would never get them. Only locks declared below the
+        trigger are returned '''
+    scopes = [it for it in scope.children if isinstance(it, Private)]
+    it = scope
+    while it is not trigger:
+        scopes.append(it)
+        it = it._parent #pylint: disable=protected-access
+
+    locks = {}
+    for it in reversed(scopes):
+        locks.update(it.properties.get(property_name, {}))
+
+    held_locks = set()
+    parent_builder = trigger
+    if isinstance(trigger, Step):
+        held_locks.update(trigger.get('_step_locks', {}))
+        parent_builder = trigger.get_parent_of_type(Builder)
+    held_locks.update(parent_builder.get('_builder_locks', {}))
+    deadlocks = held_locks.intersection(locks)
+    if deadlocks:
+        name_property = 'step_name' if isinstance(scope, Step) else 'builder_name'
+        raise Exception('Locks %s of %s are held by the build triggering it' %
+                        (', '.join(sorted(deadlocks)),
+                         scope.get_interpolated(name_property)))
+    return locks
+
+def _get_request_merger(name, max_changes):
+    if name == 'branch':
+        return _RequestMerger(merge_pinned=True)
+    if name == 'newest_revision':
+        return _RequestMerger(merge_pinned=False)
+    if name == 'max_changes':
+        return _RequestMerger(merge_pinned=False, max_changes=max_changes)
+    raise Exception('Unknown merge strategy %s' % name)
+
+class _RequestMerger(object):
+    ''' mergeRequests callable merging requests building the same branches.
+        Requests forced on a given revision are only merged with requests of
+        the same revision, unless merge_pinned is True '''
+    def __init__(self, merge_pinned, max_changes=None):
+        self._merge_pinned = merge_pinned
+        self._max_changes = max_changes
+        self._request = None
+        self._checked_ids = set()
+        self._changes_count = 0
+
+    def __call__(self, builder, request, other):
+        if len(request.sources) != len(other.sources):
+            return False
+        for codebase, source in request.sources.iteritems():
+            other_source = other.sources.get(codebase)
+            if other_source is None or not self._can_merge(source, other_source):
+                return False
+
+        if self._max_changes is not None:
+            # Buildbot checks pending requests one after the other against the
+            # oldest one, counting changes merged with it. Requests are cached,
+            # a request checked again starts a new pass, as when the build
+            # failed to start
+            if request is not self._request or other.id in self._checked_ids:
+                self._request = request
+                self._checked_ids = set()
+                self._changes_count = _get_changes_count(request)
+            self._checked_ids.add(other.id)
+            changes_count = self._changes_count + _get_changes_count(other)
+            if changes_count > self._max_changes:
+                return False
+            self._changes_count = changes_count
+
+        return True
+
+    def _can_merge(self, source, other):
+        if (source.branch != other.branch or
+                source.repository != other.repository or
+                source.project != other.project):
+            return False
+        if source.patch is not None or other.patch is not None:
+            return False
+        if self._merge_pinned:
+            return True
+
+        is_pinned = source.revision is not None and not source.changes
+        is_other_pinned = other.revision is not None and not other.changes
+        if is_pinned or is_other_pinned:
+            return source.revision == other.revision
+        return True
+
+def _get_changes_count(request):
+    return sum(len(it.changes) for it in request.sources.itervalues())
+
 class _ChangeFilter(object):
     ''' Callable filtering change matching a regular expression against modified
         files
@@ -1158,7 +1940,13 @@ class _ChangeFilter(object):
         self._reject = reject
 
     def __call__(self, change):
+        accepted = self._filter(change)
+        _METRICS.increment('ebb_change_filter_calls_total',
+                           builder=self._builder,
+                           result='accepted' if accepted else 'rejected')
+        return accepted
 
+    def _filter(self, change):
         msg_prefix = 'ChangeFilter: checking change %s with %s' % (change.revision, self._builder)
 
         if self._project != change.project:
@@ -1237,81 +2025,125 @@ class Trigger(Step):
         else:
             scheduler_class = buildbot.schedulers.triggerable.Triggerable
 
-        scheduler = scheduler_class(**args)
+        scheduler = _create(scheduler_class, **args)
 
         config.buildbot_config['schedulers'].append(scheduler)
 
         step_args['schedulerNames'] = [scheduler.name]
 
+        # Lets elastic_bot link triggered builds to the build and step that
+        # triggered them, to analyse queue time and critical path of chains.
+        set_properties = dict(self.get_interpolated('trigger_set_properties') or {})
+        set_properties.update({
+            'parent_buildername' : buildbot.process.properties.Property('buildername'),
+            'parent_buildnumber' : buildbot.process.properties.Property('buildnumber'),
+            'parent_stepname' : self.get_interpolated('step_name')
+        })
+        step_args['set_properties'] = set_properties
+
         if 'workdir' in step_args:
             del step_args['workdir']
         return self._build_class(buildbot.steps.trigger.Trigger, 'trigger',
                                  additional=step_args)
 
-def p4_email_lookup(scope):
-    ''' Returns a callable to use in the 'lookup' argument of Builder
-        mail_config that will get email from Perforce users '''
-    class _Lookup(buildbot.util.ComparableMixin):
-        zope.interface.implements(buildbot.interfaces.IEmailLookup)
-        def __init__(self, port, encoding, user, password, p4bin):
-            self._port = str(port)
-            self._encoding = encoding
-            self._user = user
-            self._password = password
-            self._p4bin = p4bin if p4bin is not None else 'p4'
-
-            assert isinstance(self._port, str)
-            assert isinstance(self._encoding, str)
-            assert isinstance(self._user, str)
-            assert isinstance(self._password, str)
-            assert isinstance(self._p4bin, str)
-
-            self._email_re = re.compile(r"Email:\s+(?P<email>\S+@\S+)\s*$")
-
-        @defer.inlineCallbacks
-        #pylint: disable=invalid-name,missing-docstring
-        def getAddress(self, name):
-            if '@' in name:
-                defer.returnValue(name)
-
-            args = []
-            if self._port:
-                args.extend(['-p', self._port])
-            if self._user:
-                args.extend(['-u', self._user])
-            if self._password:
-                args.extend(['-P', self._password])
-            args.extend(['user', '-o', name])
-            env = dict([(e, os.environ.get(e)) for e in ['PATH', 'HOME'] if os.environ.get(e)])
-            result = yield utils.getProcessOutput(self._p4bin, args, env)
-
-            if self._encoding:
-                try:
-                    result = result.decode(self._encoding)
-                except exception.UnicodeError, ex:
-                    log.msg("p4_email_lookup: couldn't decode e-mail: %s" % ex.encoding)
-                    log.msg("p4_email_lookup: in object: %s" % ex.object)
-                    log.msg("p4_email_lookup: with command: p4 %s" % ' '.join(args))
-                    raise
-
-            for line in result.split('\n'):
-                line = line.strip()
-                if not line:
-                    continue
-                match = self._email_re.match(line)
-                if match:
-                    defer.returnValue(match.group('email'))
+class _P4EmailLookup(_LazyBase):
+    _lazy_base = 'buildbot.util.ComparableMixin'
+    _lazy_interfaces = ['buildbot.interfaces.IEmailLookup']
+
+    def __init__(self, port, encoding, user, password, p4bin):
+        self._port = str(port)
+        self._encoding = encoding
+        self._user = user
+        self._password = password
+        self._p4bin = p4bin if p4bin is not None else 'p4'
+
+        assert isinstance(self._port, str)
+        assert isinstance(self._encoding, str)
+        assert isinstance(self._user, str)
+        assert isinstance(self._password, str)
+        assert isinstance(self._p4bin, str)
 
+        self._email_re = re.compile(r"Email:\s+(?P<email>\S+@\S+)\s*$")
+        # Addresses are looked up again when the config is reloaded
+        self._cache = {}
+
+    @defer.inlineCallbacks
+    #pylint: disable=invalid-name,missing-docstring
+    def getAddress(self, name):
+        if '@' in name:
+            _METRICS.increment('ebb_p4_email_lookups_total',
+                               source='address')
             defer.returnValue(name)
 
-    return _Lookup(scope.get_interpolated('p4_common_p4port'),
-                   scope.get_interpolated('p4_poll_encoding'),
-                   scope.get_interpolated('p4_common_p4user'),
-                   scope.get_interpolated('p4_common_p4passwd'),
-                   scope.get_interpolated('p4_poll_p4bin'))
+        if name in self._cache:
+            _METRICS.increment('ebb_p4_email_lookups_total',
+                               source='cache')
+            defer.returnValue(self._cache[name])
 
-class _Renderer(object):
-    zope.interface.implements(buildbot.interfaces.IRenderable)
+        _METRICS.increment('ebb_p4_email_lookups_total', source='p4')
+
+        args = []
+        if self._port:
+            args.extend(['-p', self._port])
+        if self._user:
+            args.extend(['-u', self._user])
+        if self._password:
+            args.extend(['-P', self._password])
+        args.extend(['user', '-o', name])
+        env = dict([(e, os.environ.get(e)) for e in ['PATH', 'HOME'] if os.environ.get(e)])
+        result = yield utils.getProcessOutput(self._p4bin, args, env)
+
+        if self._encoding:
+            try:
+                result = result.decode(self._encoding)
+            except exception.UnicodeError, ex:
+                log.msg("p4_email_lookup: couldn't decode e-mail: %s" % ex.encoding)
+                log.msg("p4_email_lookup: in object: %s" % ex.object)
+                log.msg("p4_email_lookup: with command: p4 %s" % ' '.join(args))
+                raise
+
+        for line in result.split('\n'):
+            line = line.strip()
+            if not line:
+                continue
+            match = self._email_re.match(line)
+            if match:
+                self._cache[name] = match.group('email')
+                defer.returnValue(self._cache[name])
+
+        self._cache[name] = name
+        defer.returnValue(name)
+
+def p4_email_lookup(scope):
+    ''' Returns a callable to use in the 'lookup' argument of Builder
+        mail_config that will get email from Perforce users '''
+    return _P4EmailLookup(scope.get_interpolated('p4_common_p4port'),
+                          scope.get_interpolated('p4_poll_encoding'),
+                          scope.get_interpolated('p4_common_p4user'),
+                          scope.get_interpolated('p4_common_p4passwd'),
+                          scope.get_interpolated('p4_poll_p4bin'))
+
+_P4_DESCRIBE_HEADER_RE = re.compile(r'Change (?P<num>\d+) by ')
+
+def _split_p4_describe(output):
+    ''' Splits the output of a multi-changes p4 describe command, yielding
+        (change number, single change description) tuples '''
+    number, start, position = None, 0, 0
+    while position < len(output):
+        line_end = output.find('\n', position)
+        line_end = len(output) if line_end == -1 else line_end + 1
+        match = _P4_DESCRIBE_HEADER_RE.match(output, position, line_end)
+        if match is not None:
+            if number is not None:
+                yield number, output[start:position]
+            number, start = match.group('num'), position
+        position = line_end
+
+    if number is not None:
+        yield number, output[start:]
+
+class _Renderer(_LazyBase):
+    _lazy_interfaces = ['buildbot.interfaces.IRenderable']
 
     def __init__(self, fmt, scope):
         self._fmt = fmt
@@ -1322,6 +2154,12 @@ class _Renderer(object):
 
     #pylint: disable=invalid-name,missing-docstring
     def getRenderingFor(self, props):
+        start = _METRICS.start_timer()
+        result = self._render(props)
+        _METRICS.observe_duration('ebb_render_seconds', start)
+        return result
+
+    def _render(self, props):
         format_vars = self._scope.get_interpolation_values()
 
         for handler in self._scope.get('config_renderer_handlers', []):
@@ -1366,6 +2204,7 @@ class _HtmlMailFormatter(object):
                 'end' : time.ctime(end),
                 'elapsed' : buildbot.util.formatInterval(end - start)}
         try:
+            import jinja2
             loader = jinja2.FileSystemLoader(template_directory,
                                              encoding='utf-8')
             env = jinja2.Environment(loader=loader)
@@ -1379,3 +2218,382 @@ class _HtmlMailFormatter(object):
         return {'body' : body,
                 'type' : mail_type}
 
+
+class _BuildEventExporter(_LazyBase):
+    ''' Sends build and step documents to a sink when they start and finish.
+        Documents are buffered, and written in batches from a thread so that
+        a slow sink never blocks the master '''
+    _lazy_base = 'buildbot.status.base.StatusReceiverMultiService'
+
+    def __init__(self, sink, flush_interval=10, batch_size=500,
+                 max_buffered=100000):
+        buildbot.status.base.StatusReceiverMultiService.__init__(self)
+        self._sink = sink
+        self._flush_interval = flush_interval
+        self._batch_size = batch_size
+        self._max_buffered = max_buffered
+        # Oldest events are dropped first when the sink can't keep up
+        self._buffer = collections.deque(maxlen=max_buffered)
+        self._flushing = None
+        self._dropped = 0
+        self._loop = task.LoopingCall(self._flush)
+        self._master_status = None
+
+    #pylint: disable=invalid-name,missing-docstring,unused-argument
+    def startService(self):
+        buildbot.status.base.StatusReceiverMultiService.startService(self)
+        self._master_status = self.parent
+        self._master_status.subscribe(self)
+        self._loop.start(self._flush_interval, now=False)
+
+    @defer.inlineCallbacks
+    def stopService(self):
+        self._master_status.unsubscribe(self)
+        if self._loop.running:
+            self._loop.stop()
+        # Waits for the running flush, then writes remaining events
+        yield self._flush()
+        yield self._flush()
+        yield buildbot.status.base.StatusReceiverMultiService.stopService(self)
+
+    def builderAdded(self, name, builder):
+        return self
+
+    def buildStarted(self, builderName, build):
+        self._add(_get_build_event(build))
+        return self
+
+    def buildFinished(self, builderName, build, results):
+        self._add(_get_build_event(build))
+
+    def stepStarted(self, build, step):
+        self._add(_get_step_event(build, step))
+
+    def stepFinished(self, build, step, results):
+        self._add(_get_step_event(build, step))
+
+    def _add(self, document):
+        if len(self._buffer) >= self._max_buffered:
+            self._dropped += 1
+        self._buffer.append(document)
+        if len(self._buffer) >= self._batch_size:
+            self._flush()
+
+    def _flush(self):
+        if self._flushing is not None:
+            return self._flushing
+        if not self._buffer:
+            return defer.succeed(None)
+
+        if self._dropped:
+            log.msg('BuildEventExporter: buffer full, dropped %s events' %
+                    self._dropped)
+            self._dropped = 0
+
+        documents = list(self._buffer)
+        self._buffer.clear()
+
+        def _on_error(failure):
+            log.msg('BuildEventExporter: writing %s events failed, they will '
+                    'be retried : %s' % (len(documents), failure))
+            # Failed events go before new ones, and the oldest are dropped
+            # if the buffer is full
+            pending = documents + list(self._buffer)
+            self._dropped += max(0, len(pending) - self._max_buffered)
+            self._buffer = collections.deque(pending,
+                                             maxlen=self._max_buffered)
+
+        def _on_done(_):
+            self._flushing = None
+
+        self._flushing = threads.deferToThread(self._sink.write, documents)
+        self._flushing.addErrback(_on_error)
+        self._flushing.addBoth(_on_done)
+        return self._flushing
+
+def _get_build_event(build):
+    start, end = build.getTimes()
+    document = _get_event('build', build, start, end, build.getResults())
+    document['_id'] = '%s_%s' % (build.getBuilder().getName(),
+                                 build.getNumber())
+
+    trigger_date = None
+    for source_stamp in build.getSourceStamps():
+        for change in source_stamp.changes:
+            trigger_date = max(trigger_date, change.when)
+    if trigger_date is not None:
+        document['waiting_duration'] = start - trigger_date
+        if end is not None:
+            document['total_duration'] = end - trigger_date
+    return document
+
+def _get_step_event(build, step):
+    start, end = step.getTimes()
+    document = _get_event('step', build, start, end, step.getResults()[0])
+    document['_id'] = '%s_%s_%s' % (build.getBuilder().getName(),
+                                    build.getNumber(),
+                                    step.step_number)
+    document['step_name'] = step.getName()
+    document['step_number'] = step.step_number
+    return document
+
+def _get_event(doc_type, build, start, end, results):
+    ''' Creates a document with the fields elastic_bot indexes, so that both
+        can write to the same index '''
+    document = {
+        'type' : doc_type,
+        'blamelist' : '-'.join(build.getResponsibleUsers()),
+        'start' : _get_iso_date(start),
+    }
+    if end is not None:
+        document['end'] = _get_iso_date(end)
+        document['duration'] = end - start
+        document['result'] = buildbot.status.builder.Results[results]
+
+    for key, (value, _) in build.getProperties().asDict().iteritems():
+        if key in ['workdir', 'scheduler', 'builddir']:
+            continue
+        if value is not None and value != '':
+            document[key] = value
+    return document
+
+def _get_iso_date(timestamp):
+    return datetime.datetime.utcfromtimestamp(timestamp).isoformat() + 'Z'
+
+class NdjsonEventSink(object):
+    ''' Appends build events to a file, a JSON document per line '''
+    def __init__(self, path):
+        self._path = path
+
+    def write(self, documents):
+        ''' Writes given documents '''
+        with open(self._path, 'ab') as ndjson_file:
+            for document in documents:
+                ndjson_file.write(json.dumps(document,
+                                             default=str,
+                                             sort_keys=True))
+                ndjson_file.write('\n')
+
+class ElasticsearchEventSink(object):
+    ''' Indexes build events with bulk requests, in the monthly indices
+        elastic_bot writes to. Documents rejected by Elasticsearch are logged
+        and dropped, the whole batch is retried by the exporter on transport
+        errors '''
+    def __init__(self, nodes, index='buildbot'):
+        # Only needed by masters exporting events to Elasticsearch
+        import elasticsearch
+        import elasticsearch.helpers
+        self._bulk = elasticsearch.helpers.bulk
+        self._client_class = elasticsearch.Elasticsearch
+        self._nodes = nodes
+        self._database = None
+        self._index = index
+
+    def write(self, documents):
+        ''' Writes given documents '''
+        if self._database is None:
+            self._database = self._client_class(self._nodes)
+
+        actions = []
+        for document in documents:
+            document = document.copy()
+            month = document['start'][:7].replace('-', '.')
+            actions.append({
+                '_index' : '%s-%s' % (self._index, month),
+                '_type' : 'doc',
+                '_id' : document.pop('_id'),
+                '_source' : document
+            })
+
+        # Transport and connection errors are still raised
+        _, errors = self._bulk(self._database, actions, raise_on_error=False)
+        for error in errors:
+            log.msg('ElasticsearchEventSink: dropping rejected event : %s' %
+                    error)
+
+class SlaveSelector(_LazyBase):
+    ''' next_slave_selector preferring the slave that last built a builder,
+        as its workspace only needs an incremental sync, then the least
+        loaded slave. Slaves with recent exceptions or retries, usually lost
+        connections or broken environments, are avoided. Failed builds are
+        not counted, they are more often caused by the change being built.
+        Set it with config.next_slave_selector = SlaveSelector() '''
+    _lazy_base = 'buildbot.status.base.StatusReceiverMultiService'
+
+    # Failures remembered per slave
+    _MAX_FAILURES = 10
+
+    def __init__(self, failure_timeout=3600, max_builders=1000):
+        buildbot.status.base.StatusReceiverMultiService.__init__(self)
+        self._failure_timeout = failure_timeout
+        self._max_builders = max_builders
+        self._last_slaves = collections.OrderedDict()
+        self._failures = {}
+        self._master_status = None
+
+    def __call__(self, builder, slave_builders):
+        if not slave_builders:
+            return None
+
+        last_slave = self._last_slaves.get(builder.name)
+        now = time.time()
+        def _get_rank(slave_builder):
+            slave = slave_builder.slave
+            failures = self._failures.get(slave.slavename, [])
+            recent_failures = sum(1 for it in failures
+                                  if now - it < self._failure_timeout)
+            running_builds = sum(1 for it in slave.slavebuilders.itervalues()
+                                 if it.isBusy())
+            load = float(running_builds) / (slave.max_builds or 1)
+            return (recent_failures,
+                    slave.slavename != last_slave,
+                    load,
+                    slave.slavename)
+
+        return min(slave_builders, key=_get_rank)
+
+    #pylint: disable=invalid-name,missing-docstring,unused-argument
+    def startService(self):
+        buildbot.status.base.StatusReceiverMultiService.startService(self)
+        self._master_status = self.parent
+        self._master_status.subscribe(self)
+
+    def stopService(self):
+        self._master_status.unsubscribe(self)
+        return buildbot.status.base.StatusReceiverMultiService.stopService(self)
+
+    def builderAdded(self, name, builder):
+        return self
+
+    def buildStarted(self, builderName, build):
+        self._last_slaves.pop(builderName, None)
+        self._last_slaves[builderName] = build.getSlavename()
+        if len(self._last_slaves) > self._max_builders:
+            self._last_slaves.popitem(last=False)
+
+    def buildFinished(self, builderName, build, results):
+        if results not in [buildbot.status.results.EXCEPTION,
+                           buildbot.status.results.RETRY]:
+            return
+
+        # Slaves come and go, those without recent failures are forgotten
+        now = time.time()
+        for name, failures in self._failures.items():
+            if now - failures[-1] >= self._failure_timeout:
+                del self._failures[name]
+
+        slave_name = build.getSlavename()
+        if slave_name not in self._failures:
+            self._failures[slave_name] = collections.deque(
+                maxlen=self._MAX_FAILURES)
+        self._failures[slave_name].append(now)
+
+class _Metrics(object):
+    ''' Counters and durations of master callbacks, exposed in the Prometheus
+        text format. Recording does nothing until the status serving them,
+        set with Config.metrics, is started '''
+    def __init__(self):
+        self.enabled = False
+        self._counters = {}
+        self._durations = {}
+        self._help = {}
+
+    def describe(self, name, help_text):
+        ''' Sets the help text of a metric '''
+        self._help[name] = help_text
+
+    def increment(self, name, **labels):
+        ''' Increments a counter '''
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.iteritems())))
+        self._counters[key] = self._counters.get(key, 0) + 1
+
+    def start_timer(self):
+        ''' Returns a start time to give to observe_duration, or None if
+            metrics are disabled '''
+        return time.time() if self.enabled else None
+
+    def observe_duration(self, name, start, **labels):
+        ''' Records the time elapsed since start_timer was called '''
+        if start is None:
+            return
+        key = (name, tuple(sorted(labels.iteritems())))
+        count, total = self._durations.get(key, (0, 0.0))
+        self._durations[key] = (count + 1, total + time.time() - start)
+
+    def render(self):
+        ''' Returns metrics in the Prometheus text format '''
+        lines = []
+        described = set()
+        def _add_header(name, metric_type):
+            if name in described:
+                return
+            described.add(name)
+            if name in self._help:
+                lines.append('# HELP %s %s' % (name, self._help[name]))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+
+        for (name, labels), value in sorted(self._counters.iteritems()):
+            _add_header(name, 'counter')
+            lines.append('%s%s %s' % (name, _format_labels(labels), value))
+
+        for (name, labels), (count, total) in sorted(self._durations.iteritems()):
+            _add_header(name, 'summary')
+            labels = _format_labels(labels)
+            lines.append('%s_count%s %s' % (name, labels, count))
+            lines.append('%s_sum%s %r' % (name, labels, total))
+
+        return ''.join(it + '\n' for it in lines)
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    def _escape(value):
+        value = unicode(value).encode('utf-8')
+        return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{%s}' % ','.join('%s="%s"' % (key, _escape(value))
+                             for key, value in labels)
+
+_METRICS = _Metrics()
+_METRICS.describe('ebb_change_filter_calls_total',
+                  'Changes checked by builder change filters')
+_METRICS.describe('ebb_prioritize_builders_seconds',
+                  'Time spent sorting builders by priority, without getting '
+                  'request ages from the database')
+_METRICS.describe('ebb_render_seconds',
+                  'Time spent rendering properties at build time')
+_METRICS.describe('ebb_p4_email_lookups_total',
+                  'Perforce user e-mail lookups, by source of the address')
+_METRICS.describe('ebb_p4_poll_seconds', 'Duration of Perforce polls')
+
+class _MetricsResource(_LazyBase):
+    _lazy_base = 'twisted.web.resource.Resource'
+    isLeaf = True
+
+    #pylint: disable=invalid-name,missing-docstring
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+        return _METRICS.render()
+
+class _MetricsStatus(_LazyBase):
+    ''' Serves metrics on given port, for Prometheus to scrape '''
+    _lazy_base = 'buildbot.status.base.StatusReceiverMultiService'
+
+    def __init__(self, port):
+        from twisted.application import strports
+        from twisted.web import server
+        buildbot.status.base.StatusReceiverMultiService.__init__(self)
+        site = server.Site(_MetricsResource())
+        strports.service('tcp:%d' % port, site).setServiceParent(self)
+
+    # Metrics are only recorded while served, not when the config is only
+    # checked or loaded, nor after the status is removed on reconfig
+    #pylint: disable=invalid-name,missing-docstring
+    def startService(self):
+        buildbot.status.base.StatusReceiverMultiService.startService(self)
+        _METRICS.enabled = True
+
+    def stopService(self):
+        _METRICS.enabled = False
+        return buildbot.status.base.StatusReceiverMultiService.stopService(self)
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014—2016 Dontnod Entertainment
+
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+''' Writes buildbot builder directories, with the status pickles a master
+    saves '''
+
+import cPickle
+import os
+
+import buildbot.changes.changes
+import buildbot.sourcestamp
+import buildbot.status.build
+import buildbot.status.builder
+
+def write_builder(builders_dir, builder_name, builds):
+    ''' Writes the builder_name directory in builders_dir, with a build pickle
+        for each (number, started, [(step name, duration), ...]) of builds.
+        Returns the builder directory '''
+    builder_dir = os.path.join(builders_dir, builder_name)
+    if not os.path.isdir(builder_dir):
+        os.makedirs(builder_dir)
+
+    builder = buildbot.status.builder.BuilderStatus(builder_name, None, None,
+                                                    None)
+    # Set by the master, and removed when pickled
+    builder.basedir = builder_dir
+    builder.status = None
+    builder.nextBuildNumber = 0
+    builder.currentBigState = 'idle'
+    _dump(builder, os.path.join(builder_dir, 'builder'))
+
+    for number, started, steps in builds:
+        write_build(builder_dir, builder, number, started, steps)
+    return builder_dir
+
+def write_build(builder_dir, builder, number, started, steps,
+                properties=None):
+    ''' Writes a successful build pickle, and returns the build. builder
+        defaults to the one pickled in builder_dir '''
+    if builder is None:
+        with open(os.path.join(builder_dir, 'builder'), 'rb') as builder_file:
+            builder = cPickle.load(builder_file)
+    build = buildbot.status.build.BuildStatus(builder, None, number)
+    build.started = started
+    build.results = buildbot.status.builder.SUCCESS
+    build.blamelist = ['author']
+    build.properties.setProperty('project_name', 'tools', 'test')
+    for name, value in (properties or {}).iteritems():
+        build.properties.setProperty(name, value, 'test')
+    change = buildbot.changes.changes.Change('author', ['file'], 'comment',
+                                             when=started - 10)
+    build.setSourceStamps([buildbot.sourcestamp.SourceStamp(branch='main',
+                                                            changes=[change])])
+    step_started = started
+    for name, duration in steps:
+        step = build.addStepWithName(name)
+        step.started = step_started
+        step.finished = step_started + duration
+        step.results = buildbot.status.builder.SUCCESS
+        step_started = step.finished
+    build.finished = step_started
+    _dump(build, os.path.join(builder_dir, str(number)))
+    return build
+
+def _dump(status, path):
+    with open(path, 'wb') as status_file:
+        cPickle.dump(status, status_file, cPickle.HIGHEST_PROTOCOL)
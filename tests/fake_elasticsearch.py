@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014—2016 Dontnod Entertainment
+
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+''' Fake Elasticsearch HTTP server, answering bulk requests as tests
+    script it '''
+
+import BaseHTTPServer
+import json
+import threading
+
+import elasticsearch
+
+class BulkHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    ''' Answers bulk requests with the statuses returned by the server
+        respond callable. The cluster has no index, searches fail '''
+    def do_POST(self): #pylint: disable=invalid-name
+        ''' Records the bulk request and answers it '''
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        lines = body.splitlines()
+        ids = [json.loads(it).values()[0]['_id'] for it in lines[::2]]
+        self.server.requests.append((body, ids))
+        status, item_statuses = self.server.respond(ids)
+        if item_statuses is None:
+            response = {'error' : 'overloaded', 'status' : status}
+        else:
+            items = [{'index' : {'_id' : doc_id, 'status' : it,
+                                 'error' : None if it < 300 else 'error %s' % it}}
+                     for doc_id, it in zip(ids, item_statuses)]
+            response = {'took' : 1, 'errors' : False, 'items' : items}
+        self._send_response(status, response)
+
+    def do_GET(self): #pylint: disable=invalid-name
+        ''' Answers searches as a cluster without indices '''
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        error = {'type' : 'index_not_found_exception',
+                 'reason' : 'no such index'}
+        self._send_response(404, {'error' : error, 'status' : 404})
+
+    def _send_response(self, status, response):
+        content = json.dumps(response)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *_): #pylint: disable=arguments-differ
+        pass
+
+def start_server(test_case):
+    ''' Starts a fake Elasticsearch, stopped when test_case ends '''
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), BulkHandler)
+    server.requests = []
+    server.respond = lambda ids: (200, [201] * len(ids))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    test_case.addCleanup(server.server_close)
+    test_case.addCleanup(server.shutdown)
+    return server
+
+def get_client(server):
+    ''' Returns an Elasticsearch client of a fake Elasticsearch '''
+    host = '127.0.0.1:%s' % server.server_address[1]
+    return elasticsearch.Elasticsearch([host], max_retries=0)
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014—2016 Dontnod Entertainment
+
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+''' elastic_bot build pickles loading tests '''
+
+import cPickle
+import datetime
+import os
+import sys
+
+import dateutil.tz
+from twisted.trial import unittest
+
+from tests import buildbot_status
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir,
+                                'utilities'))
+#pylint: disable=import-error,wrong-import-position
+import elastic_bot
+
+#pylint: disable=protected-access
+
+class _Command(object):
+    ''' Runs a shell command when unpickled '''
+    def __init__(self, command):
+        self._command = command
+
+    def __reduce__(self):
+        return (os.system, (self._command,))
+
+class LoadPickleTest(unittest.TestCase):
+    ''' Checks buildbot pickles are loaded without running pickled calls '''
+    def setUp(self):
+        self._directory = os.path.abspath(self.mktemp())
+        self._marker_path = os.path.join(self._directory, 'marker')
+
+    def _get_command(self):
+        return _Command('touch %s' % self._marker_path)
+
+    def test_unsafe_global_ignored(self):
+        ''' Globals not allowed are loaded as ignored objects, and not
+            called '''
+        os.makedirs(self._directory)
+        pickle_path = os.path.join(self._directory, 'pickle')
+        with open(pickle_path, 'wb') as pickle_file:
+            cPickle.dump({'value' : self._get_command()}, pickle_file,
+                         cPickle.HIGHEST_PROTOCOL)
+
+        loaded = elastic_bot._load_pickle(pickle_path)
+        self.assertIsInstance(loaded['value'], elastic_bot._IgnoredObject)
+        self.assertFalse(os.path.exists(self._marker_path))
+
+    def test_build_documents(self):
+        ''' Documents are created from buildbot status pickles, without
+            ignored property values '''
+        builder_dir = buildbot_status.write_builder(self._directory, 'builder',
+                                                    [])
+        build = buildbot_status.write_build(builder_dir, None, 3, 1000.0,
+                                            [('sync', 5), ('compile', 30)],
+                                            {'command' : self._get_command(),
+                                             'commands' : ['make',
+                                                           self._get_command()]})
+
+        self.assertEqual('builder', elastic_bot._load_builder_name(
+            os.path.join(builder_dir, 'builder')))
+        _, _, actions = elastic_bot._get_build_actions(
+            'buildbot', 'builder', os.path.join(builder_dir, '3'),
+            dateutil.tz.tzutc(), False)
+        self.assertFalse(os.path.exists(self._marker_path))
+
+        self.assertEqual(['builder_3_0', 'builder_3_1', 'builder_3'],
+                         [it['_id'] for it in actions])
+        documents = [it['_source'] for it in actions]
+        self.assertEqual(['sync', 'compile'],
+                         [it['step_name'] for it in documents[:2]])
+        self.assertEqual([5, 30, 35], [it['duration'] for it in documents])
+        self.assertEqual(['success'] * 3, [it['result'] for it in documents])
+        self.assertEqual(datetime.datetime.fromtimestamp(
+            build.started, dateutil.tz.tzutc()), documents[2]['start'])
+        self.assertEqual(10, documents[2]['waiting_duration'])
+        self.assertEqual('author', documents[2]['blamelist'])
+        self.assertEqual('tools', documents[2]['project_name'])
+        self.assertNotIn('command', documents[2])
+        self.assertEqual(['make', None], documents[2]['commands'])
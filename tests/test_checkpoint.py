@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014—2016 Dontnod Entertainment
+
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+''' elastic_bot checkpoint tests '''
+
+import os
+import sys
+
+from twisted.trial import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir,
+                                'utilities'))
+#pylint: disable=import-error,wrong-import-position
+import elastic_bot
+
+#pylint: disable=protected-access
+
+class CheckpointTest(unittest.TestCase):
+    ''' Checks builds listed again after a checkpoint is saved and loaded '''
+    def test_pending_builds_saved(self):
+        ''' Builds not indexed below the last indexed one are listed again,
+            deleted ones are forgotten '''
+        path = os.path.abspath(self.mktemp())
+        checkpoint = elastic_bot._Checkpoint({'builder' : 1})
+        self.assertEqual([2, 3, 4, 5],
+                         checkpoint.list_builds('builder', [0, 1, 2, 3, 4, 5]))
+        checkpoint.set_done('builder', 2)
+        checkpoint.set_done('builder', 4)
+        checkpoint.save(path)
+
+        loaded = elastic_bot._Checkpoint.load(path)
+        self.assertFalse(loaded.should_index('builder', 2))
+        self.assertTrue(loaded.should_index('builder', 3))
+        self.assertEqual([3, 5], loaded.list_builds('builder', [2, 3, 4, 5]))
+        self.assertEqual([5], loaded.list_builds('builder', [2, 4, 5]))
+        self.assertEqual([0], loaded.list_builds('other', [0]))
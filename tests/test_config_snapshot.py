@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014—2016 Dontnod Entertainment
+
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+''' Config snapshots tests '''
+
+import os
+import types
+
+from twisted.trial import unittest
+
+import ebb
+
+_SOURCES = [os.path.abspath(os.path.splitext(__file__)[0] + '.py')]
+
+class ConfigSnapshotTest(unittest.TestCase):
+    ''' Checks configs loaded from snapshots are the built ones '''
+    def setUp(self):
+        self._path = os.path.abspath(self.mktemp())
+
+    def test_load_matches_build(self):
+        ''' A loaded snapshot equals the config built without snapshot '''
+        built_config = _build_config()
+        _build_config(self._path, 'key')
+        loaded_config = ebb.load_config_snapshot(self._path, _SOURCES, 'key')
+
+        self.assertNotEqual(None, loaded_config)
+        self.assertEqual(sorted(built_config), sorted(loaded_config))
+        for name in sorted(built_config):
+            self.assertEqual(_describe(built_config[name]),
+                             _describe(loaded_config[name]),
+                             '%s differs' % name)
+
+    def test_key_changed(self):
+        ''' Snapshots saved with another key are not loaded '''
+        _build_config(self._path, 'key')
+        self.assertEqual(None, ebb.load_config_snapshot(self._path, _SOURCES,
+                                                        'other key'))
+
+def _build_config(snapshot_path=None, snapshot_key=None):
+    with ebb.Config() as config:
+        ebb.Config.db('sqlite:///state.sqlite')
+        ebb.Config.nightly_stagger(1, 5)
+        ebb.Builder.add_lock('link', 'counting', 2)
+        config.next_slave_selector = ebb.SlaveSelector()
+        with ebb.Slave('slave'):
+            ebb.Slave.config('password')
+        with ebb.GitRepository('tools', 'git://localhost/tools.git', True):
+            ebb.Scope.set('project_name', 'tools')
+            for index in range(2):
+                with ebb.Builder('builder-%s' % index) as builder:
+                    ebb.Builder.config(merge_requests='branch')
+                    builder.trigger_on_change('main/.*')
+                    builder.trigger_nightly(hour=2, minute=0)
+                    with ebb.Sync('tools'):
+                        pass
+                    with ebb.Command('compile', 'make {builder_name}'):
+                        ebb.Command.set_decode_rc(3, 'warnings')
+                    with ebb.Trigger.builder('builder-%s-tests' % index):
+                        with ebb.Command('test', 'make test'):
+                            pass
+    return config.build_config(snapshot_path, _SOURCES, snapshot_key)
+
+def _describe(value, seen=None):
+    ''' Returns a comparable description of a buildbot config value, objects
+        being described by their class and attributes '''
+    seen = set() if seen is None else seen
+    if isinstance(value, (basestring, int, long, float, types.NoneType)):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [_describe(it, seen) for it in value]
+    if isinstance(value, (set, frozenset)):
+        return sorted(_describe(it, seen) for it in value)
+    if isinstance(value, dict):
+        # Sorted first, seen objects must be met in the same order
+        return [(_describe(key, seen), _describe(value[key], seen))
+                for key in sorted(value)]
+    if isinstance(value, (types.FunctionType, types.BuiltinFunctionType,
+                          type, types.ClassType)):
+        return value.__name__
+    if isinstance(value, types.MethodType):
+        return ('method', value.__name__, _describe(value.im_self, seen))
+
+    # Objects referenced again, as in cycles, are only described once
+    if id(value) in seen:
+        return ('seen', type(value).__name__)
+    seen.add(id(value))
+    return (type(value).__name__,
+            _describe(getattr(value, '__dict__', None), seen))
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014—2016 Dontnod Entertainment
+
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+''' elastic_bot Elasticsearch sink tests, against a fake bulk endpoint '''
+
+import json
+import os
+import sys
+
+from twisted.trial import unittest
+
+from tests import fake_elasticsearch
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir,
+                                'utilities'))
+#pylint: disable=import-error,wrong-import-position
+import elastic_bot
+
+class ElasticsearchSinkTest(unittest.TestCase):
+    ''' Checks bulk requests batching, retries and rejected documents '''
+    def setUp(self):
+        self._server = fake_elasticsearch.start_server(self)
+        self.patch(elastic_bot, '_INITIAL_BACKOFF', 0)
+        self._dead_letter_path = os.path.abspath(self.mktemp())
+
+    def _write(self, actions, max_chunk_bytes=10 * 1024 * 1024, max_retries=2):
+        database = fake_elasticsearch.get_client(self._server)
+        sink = elastic_bot._ElasticsearchSink(database, 1, max_chunk_bytes,
+                                              max_retries,
+                                              self._dead_letter_path)
+        try:
+            return list(sink.write(actions))
+        finally:
+            sink.close()
+
+    def _read_dead_letters(self):
+        if not os.path.exists(self._dead_letter_path):
+            return []
+        with open(self._dead_letter_path) as dead_letter_file:
+            return [json.loads(it) for it in dead_letter_file]
+
+    def test_chunks_bounded_in_bytes(self):
+        ''' Bulk requests don't exceed max_chunk_bytes '''
+        actions = _get_actions(20)
+        results = self._write(actions, max_chunk_bytes=1024)
+
+        self.assertEqual([(True, it['_id']) for it in actions],
+                         [(success, doc_id) for success, doc_id, _ in results])
+        self.assertTrue(len(self._server.requests) > 1)
+        for body, _ in self._server.requests:
+            self.assertTrue(len(body) <= 1024)
+        sent_ids = [it for _, ids in self._server.requests for it in ids]
+        self.assertEqual([it['_id'] for it in actions], sent_ids)
+
+    def test_retries_overloaded_documents(self):
+        ''' Only documents rejected with a 429 status are sent again '''
+        responses = [[429, 201, 429, 201], [201, 201]]
+        self._server.respond = lambda ids: (200, responses.pop(0))
+        actions = _get_actions(4)
+        results = self._write(actions)
+
+        self.assertTrue(all(success for success, _, _ in results))
+        self.assertEqual(['build_0', 'build_2'], self._server.requests[1][1])
+        self.assertEqual([], self._read_dead_letters())
+
+    def test_retries_overloaded_cluster(self):
+        ''' Bulk requests failing with a 429 status are sent again '''
+        responses = [(429, None), (200, [201, 201])]
+        self._server.respond = lambda ids: responses.pop(0)
+        results = self._write(_get_actions(2))
+
+        self.assertTrue(all(success for success, _, _ in results))
+        self.assertEqual(2, len(self._server.requests))
+
+    def test_dead_letter(self):
+        ''' Documents rejected for good, or still overloaded after the last
+            retry, are written to the dead letter file '''
+        statuses = {'build_0' : 201, 'build_1' : 400, 'build_2' : 429}
+        self._server.respond = lambda ids: (200, [statuses[it] for it in ids])
+        results = self._write(_get_actions(3), max_retries=1)
+
+        self.assertEqual([True, False, False],
+                         [success for success, _, _ in results])
+        dead_letters = self._read_dead_letters()
+        self.assertEqual(['build_1', 'build_2'],
+                         sorted(it['_id'] for it in dead_letters))
+        self.assertEqual(1, dead_letters[0]['document']['index'])
+        self.assertEqual('error 400', dead_letters[0]['error'])
+
+class GetLastBuildsTest(unittest.TestCase):
+    ''' Checks the checkpoint rebuilt from Elasticsearch '''
+    def test_missing_index(self):
+        ''' A cluster without indices gives an empty checkpoint '''
+        database = fake_elasticsearch.get_client(fake_elasticsearch.start_server(self))
+        self.assertEqual({}, elastic_bot._get_last_builds(database, 'buildbot'))
+
+def _get_actions(count):
+    return [{'_index' : 'buildbot-2020.01',
+             '_type' : 'build',
+             '_id' : 'build_%s' % it,
+             '_source' : {'index' : it, 'padding' : 'x' * 100}}
+            for it in range(count)]
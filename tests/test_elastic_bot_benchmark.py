@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014—2016 Dontnod Entertainment
+
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+''' elastic_bot benchmark smoke test '''
+
+import os
+import StringIO
+import sys
+
+from twisted.trial import unittest
+
+from tests import buildbot_status
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir,
+                                'utilities'))
+#pylint: disable=import-error,wrong-import-position
+import elastic_bot_benchmark
+
+class BenchmarkTest(unittest.TestCase):
+    ''' Runs the benchmark, so that it follows elastic_bot changes '''
+    def test_run(self):
+        ''' Builds of a builder directory are measured in both modes '''
+        builders_dir = os.path.abspath(self.mktemp())
+        builds = [(it, 1000.0 + it * 100, [('sync', 5), ('compile', 30)])
+                  for it in range(3)]
+        buildbot_status.write_builder(builders_dir, 'builder', builds)
+        output = StringIO.StringIO()
+        self.patch(sys, 'stdout', output)
+        self.patch(sys, 'argv', ['elastic_bot_benchmark.py',
+                                 '--builders-dir', builders_dir])
+
+        self.assertEqual(0, elastic_bot_benchmark.main())
+        lines = output.getvalue().splitlines()
+        self.assertIn('Benchmarking 3 builds from %s' % builders_dir, lines)
+        for mode in ['full steps', 'slim steps']:
+            row = [it.split() for it in lines if it.startswith(mode)]
+            self.assertEqual(['3', '6'], row[0][2:4])
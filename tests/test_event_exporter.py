@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014—2016 Dontnod Entertainment
+
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+''' Build event exporter and event sinks tests '''
+
+import json
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+import elasticsearch
+
+import ebb
+from tests import fake_elasticsearch
+
+class _Sink(object):
+    ''' Records written documents, failing the writes it is told to '''
+    def __init__(self):
+        self.documents = []
+        self.failures = 0
+
+    def write(self, documents):
+        ''' Fails or records given documents '''
+        if self.failures > 0:
+            self.failures -= 1
+            raise IOError('sink unavailable')
+        self.documents.extend(documents)
+
+class BuildEventExporterTest(unittest.TestCase):
+    ''' Checks buffering of events while the sink is slow or failing '''
+    def setUp(self):
+        self._sink = _Sink()
+        #pylint: disable=protected-access
+        self._exporter = ebb._BuildEventExporter(self._sink, batch_size=100,
+                                                 max_buffered=3)
+
+    def test_oldest_dropped(self):
+        ''' Oldest events are dropped once the buffer is full '''
+        for event in range(5):
+            self._exporter._add(event) #pylint: disable=protected-access
+        self.assertEqual([2, 3, 4], list(self._exporter._buffer))
+        self.assertEqual(2, self._exporter._dropped)
+
+    @defer.inlineCallbacks
+    def test_failed_write_retried(self):
+        ''' Events of a failed write are written again before newer ones '''
+        #pylint: disable=protected-access
+        self._sink.failures = 1
+        self._exporter._add(0)
+        self._exporter._add(1)
+        yield self._exporter._flush()
+        self.assertEqual([0, 1], list(self._exporter._buffer))
+
+        self._exporter._add(2)
+        self._exporter._add(3)
+        self.assertEqual(1, self._exporter._dropped)
+        yield self._exporter._flush()
+        self.assertEqual([1, 2, 3], self._sink.documents)
+
+class ElasticsearchEventSinkTest(unittest.TestCase):
+    ''' Checks errors of bulk requests sent by the sink '''
+    def _write(self, port):
+        sink = ebb.ElasticsearchEventSink(['127.0.0.1:%s' % port])
+        sink.write([{'_id' : 'builder_%s' % it,
+                     'type' : 'build',
+                     'start' : '2020-01-02T03:04:05Z'} for it in range(3)])
+
+    def test_rejected_dropped(self):
+        ''' Documents rejected by Elasticsearch don't fail the write, so
+            that they are not sent again '''
+        server = fake_elasticsearch.start_server(self)
+        server.respond = lambda ids: (200, [201, 400, 429])
+        self._write(server.server_address[1])
+        self.assertEqual(1, len(server.requests))
+        meta = json.loads(server.requests[0][0].splitlines()[0])
+        self.assertEqual('buildbot-2020.01', meta['index']['_index'])
+
+    def test_transport_error_raised(self):
+        ''' Failed bulk requests fail the write, the exporter retries it '''
+        server = fake_elasticsearch.start_server(self)
+        server.respond = lambda ids: (500, None)
+        self.assertRaises(elasticsearch.TransportError, self._write,
+                          server.server_address[1])
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014—2016 Dontnod Entertainment
+
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+''' GitLsRemotePoller tests, against a local bare repository '''
+
+import os
+import subprocess
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+import ebb
+
+class GitLsRemotePollerTest(unittest.TestCase):
+    ''' Checks fetches are skipped when remote refs didn't change '''
+    def setUp(self):
+        directory = os.path.abspath(self.mktemp())
+        os.makedirs(directory)
+        self._remote = os.path.join(directory, 'remote.git')
+        self._clone = os.path.join(directory, 'clone')
+        self._workdir = os.path.join(directory, 'poller')
+        _git(directory, 'init', '--bare', self._remote)
+        _git(directory, 'clone', self._remote, self._clone)
+        self._push()
+
+        # Fetches are what the check saves, the base poll is only counted
+        ebb._import_buildbot()
+        self.fetches = []
+        def _poll(_):
+            self.fetches.append(None)
+            return defer.succeed(None)
+        self.patch(ebb.buildbot.changes.gitpoller.GitPoller, 'poll', _poll)
+
+    def _push(self):
+        _git(self._clone, 'commit', '--allow-empty', '-m', 'change')
+        _git(self._clone, 'push', 'origin', 'HEAD:refs/heads/master')
+
+    def _create_poller(self, repourl=None, ls_remote_check=True):
+        poller = ebb.GitLsRemotePoller(repourl=repourl or self._remote,
+                                       branches=['master'],
+                                       workdir=self._workdir,
+                                       ls_remote_check=ls_remote_check)
+        state = {}
+        poller.getState = lambda name, default: defer.succeed(state.get(name, default))
+        poller.setState = lambda name, value: defer.succeed(state.update({name : value}))
+        return poller
+
+    @defer.inlineCallbacks
+    def test_skips_unchanged_refs(self):
+        ''' Fetches once per remote change '''
+        poller = self._create_poller()
+        yield poller.poll()
+        yield poller.poll()
+        self.assertEqual(len(self.fetches), 1)
+
+        self._push()
+        yield poller.poll()
+        yield poller.poll()
+        self.assertEqual(len(self.fetches), 2)
+
+    @defer.inlineCallbacks
+    def test_check_disabled(self):
+        ''' Every poll fetches when the check is disabled '''
+        poller = self._create_poller(ls_remote_check=False)
+        yield poller.poll()
+        yield poller.poll()
+        self.assertEqual(len(self.fetches), 2)
+
+    @defer.inlineCallbacks
+    def test_ls_remote_failure(self):
+        ''' A failing ls-remote falls back to fetching '''
+        poller = self._create_poller(repourl=self._remote + '-missing')
+        yield poller.poll()
+        yield poller.poll()
+        self.assertEqual(len(self.fetches), 2)
+
+    def test_compare_attrs(self):
+        ''' Toggling the check changes the poller, so it is reconfigured '''
+        self.assertEqual(self._create_poller(), self._create_poller())
+        self.assertNotEqual(self._create_poller(),
+                            self._create_poller(ls_remote_check=False))
+
+def _git(cwd, *args):
+    subprocess.check_call(['git', '-c', 'user.name=ebb',
+                           '-c', 'user.email=ebb@localhost'] + list(args),
+                          cwd=cwd,
+                          stdout=open(os.devnull, 'w'),
+                          stderr=subprocess.STDOUT)
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014—2016 Dontnod Entertainment
+
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+''' Lazy classes tests '''
+
+import cPickle
+
+from twisted.trial import unittest
+
+import ebb
+
+class _Selector(ebb.SlaveSelector):
+    def __init__(self, failure_timeout):
+        ebb.SlaveSelector.__init__(self, failure_timeout)
+        self.selected = 0
+
+class LazyClassTest(unittest.TestCase):
+    ''' Checks lazy classes can be subclassed and pickled '''
+    def test_subclass(self):
+        ''' Subclasses of lazy classes get their own actual class '''
+        #pylint: disable=protected-access
+        selector = _Selector(60)
+
+        self.assertIsInstance(selector, _Selector)
+        self.assertIsInstance(selector, ebb.SlaveSelector)
+        self.assertIsNot(_Selector, type(selector))
+        self.assertIsNot(type(ebb.SlaveSelector()), type(selector))
+        self.assertEqual(['_Selector', '_Selector', 'SlaveSelector'],
+                         [it.__name__ for it in type(selector).__mro__[:3]])
+        self.assertEqual(60, selector._failure_timeout)
+        self.assertEqual(0, selector.selected)
+
+    def test_pickle(self):
+        ''' Lazy instances are unpickled as instances of the actual class '''
+        #pylint: disable=protected-access
+        selector = _Selector(60)
+        selector.selected = 2
+        unpickled = cPickle.loads(cPickle.dumps(selector,
+                                                cPickle.HIGHEST_PROTOCOL))
+
+        self.assertIs(type(selector), type(unpickled))
+        self.assertEqual(60, unpickled._failure_timeout)
+        self.assertEqual(2, unpickled.selected)
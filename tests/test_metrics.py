@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014—2016 Dontnod Entertainment
+
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+''' Metrics tests '''
+
+from twisted.internet import defer
+from twisted.trial import unittest
+from twisted.web.client import getPage
+
+import ebb
+
+#pylint: disable=protected-access
+
+class MetricsTest(unittest.TestCase):
+    ''' Checks recorded metrics and their Prometheus text exposition '''
+    def setUp(self):
+        self._now = 1000.0
+        self.patch(ebb.time, 'time', lambda: self._now)
+        self._metrics = ebb._Metrics()
+        self.patch(ebb, '_METRICS', self._metrics)
+
+    def test_disabled(self):
+        ''' Nothing is recorded until metrics are enabled '''
+        self._metrics.increment('calls_total', builder='a')
+        self._metrics.observe_duration('poll_seconds',
+                                       self._metrics.start_timer())
+        self.assertEqual('', self._metrics.render())
+
+    def test_render(self):
+        ''' Counters and durations are rendered per labels, with their help '''
+        self._metrics.enabled = True
+        self._metrics.describe('calls_total', 'Calls')
+        for builder in ['b', 'a', 'b']:
+            self._metrics.increment('calls_total', builder=builder,
+                                    result='ok')
+        self._metrics.increment('calls_total', builder='a "quoted"\n')
+        for duration in [1.5, 0.5]:
+            start = self._metrics.start_timer()
+            self._now += duration
+            self._metrics.observe_duration('poll_seconds', start)
+
+        self.assertEqual('# HELP calls_total Calls\n'
+                         '# TYPE calls_total counter\n'
+                         'calls_total{builder="a",result="ok"} 1\n'
+                         'calls_total{builder="a \\"quoted\\"\\n"} 1\n'
+                         'calls_total{builder="b",result="ok"} 2\n'
+                         '# TYPE poll_seconds summary\n'
+                         'poll_seconds_count 2\n'
+                         'poll_seconds_sum 2.0\n',
+                         self._metrics.render())
+
+    @defer.inlineCallbacks
+    def test_status(self):
+        ''' Metrics are enabled while their status runs, and served over
+            HTTP '''
+        status = ebb._MetricsStatus(0)
+        self.assertFalse(self._metrics.enabled)
+
+        status.startService()
+        try:
+            self.assertTrue(self._metrics.enabled)
+            self._metrics.increment('calls_total')
+            # Listening on TCP is synchronous, waiting on the port would
+            # take it from the service
+            listening_port = status.services[0]._waitingForPort.result
+            content = yield getPage('http://127.0.0.1:%s/metrics' %
+                                    listening_port.getHost().port)
+        finally:
+            yield status.stopService()
+
+        self.assertFalse(self._metrics.enabled)
+        self.assertEqual('# TYPE calls_total counter\ncalls_total 1\n',
+                         content)
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014—2016 Dontnod Entertainment
+
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+''' P4 poller batched describe tests '''
+
+from buildbot.changes import p4poller
+from twisted.internet import defer
+from twisted.trial import unittest
+
+import ebb
+
+#pylint: disable=protected-access
+
+_DESCRIPTIONS = {
+    '11' : ('Change 11 by alice@ws on 2016/01/01 10:00:00\n'
+            '\n'
+            '\tFix build\n'
+            '\n'
+            'Affected files ...\n'
+            '\n'
+            '... //depot/a.c#2 edit\n'
+            '\n'),
+    '12' : ('Change 12 by bob@ws on 2016/01/01 11:00:00\n'
+            '\n'
+            '\tRevert\n'
+            '\tChange 11 by alice@ws on 2016/01/01 10:00:00\n'
+            'Change 11 broke the build\n'
+            '\n'
+            'Affected files ...\n'
+            '\n'
+            '... //depot/a.c#3 edit\n'
+            '\n'),
+    '13' : ('Change 13 by carol@ws on 2016/01/01 12:00:00\n'
+            '\n'
+            '\tAdd b\n'
+            '\n'
+            'Affected files ...\n'
+            '\n'
+            '... //depot/b.c#1 add\n'),
+}
+
+class SplitDescribeTest(unittest.TestCase):
+    ''' Checks multi-changes p4 describe outputs are split per change '''
+    def test_split(self):
+        ''' Description lines starting with Change don't start a change '''
+        output = ''.join(_DESCRIPTIONS[it] for it in ['11', '12', '13'])
+        self.assertEqual(sorted(_DESCRIPTIONS.items()),
+                         list(ebb._split_p4_describe(output)))
+
+    def test_empty(self):
+        ''' Outputs without changes are empty '''
+        self.assertEqual([], list(ebb._split_p4_describe('')))
+
+class BatchedDescribeTest(unittest.TestCase):
+    ''' Checks changes are described in batches by the P4 poller '''
+    def setUp(self):
+        self._calls = []
+        self._missing = set()
+        self.patch(p4poller.P4Source, '_get_process_output',
+                   self._get_process_output)
+        self._source = ebb.P4StreamSource(describe_batch_size=3,
+                                          p4port='p4:1666', p4base='//depot/')
+
+    def _get_process_output(self, args):
+        self._calls.append(args)
+        changes = args[args.index('-s') + 1:]
+        return defer.succeed(''.join(_DESCRIPTIONS[it] for it in changes
+                                     if it not in self._missing))
+
+    @defer.inlineCallbacks
+    def _describe(self, change):
+        output = yield self._source._get_process_output(
+            ['-p', 'p4:1666', 'describe', '-s', change])
+        defer.returnValue(output)
+
+    @defer.inlineCallbacks
+    def test_batches(self):
+        ''' Pending changes are described at once '''
+        self._source._pending_changes = ['11', '12', '13']
+        for change in ['11', '12', '13']:
+            output = yield self._describe(change)
+            self.assertEqual(_DESCRIPTIONS[change], output)
+
+        self.assertEqual([['-p', 'p4:1666', 'describe', '-s', '11', '12',
+                           '13']], self._calls)
+
+    @defer.inlineCallbacks
+    def test_missing_change(self):
+        ''' Changes missing from a batched output are described alone '''
+        self._source._pending_changes = ['11', '12', '13']
+        self._missing.add('12')
+        outputs = []
+        for change in ['11', '12', '13']:
+            output = yield self._describe(change)
+            outputs.append(output)
+
+        self.assertEqual([_DESCRIPTIONS['11'], '', _DESCRIPTIONS['13']],
+                         outputs)
+        self.assertEqual([['-p', 'p4:1666', 'describe', '-s', '11', '12', '13'],
+                          ['-p', 'p4:1666', 'describe', '-s', '12', '13'],
+                          ['-p', 'p4:1666', 'describe', '-s', '12']],
+                         self._calls)
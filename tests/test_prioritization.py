@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014—2016 Dontnod Entertainment
+
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+''' Builder prioritization tests '''
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+import ebb
+
+class _Builder(object):
+    ''' Mimics the buildbot builder attributes read by prioritization '''
+    def __init__(self, name, running_builds):
+        self.name = name
+        self.building = [None] * running_builds
+
+    #pylint: disable=invalid-name
+    def getOldestRequestTime(self):
+        ''' Only called for builders with priority aging '''
+        raise AssertionError('Request age of %s queried' % self.name)
+
+class _Master(object):
+    ''' Mimics the buildbot master attributes read by prioritization '''
+    def __init__(self, builders):
+        self.botmaster = self
+        self.builders = dict((it.name, it) for it in builders)
+
+class PrioritizeBuildersTest(unittest.TestCase):
+    ''' Checks the order of builders with pending requests '''
+    @defer.inlineCallbacks
+    def test_fair_share_counts_all_builders(self):
+        ''' Builds running on builders without pending requests count in the
+            share of their category '''
+        config = ebb.Config()
+        builders = []
+        with config:
+            for name, category, priority, running_builds in [
+                    ('gate-idle', 'gate', 10, 3),
+                    ('gate', 'gate', 10, 0),
+                    ('tools', 'tools', 0, 0)]:
+                with ebb.Builder(name, category) as scope:
+                    ebb.Builder.config(priority=priority, fair_share=1)
+                builder = _Builder(name, running_builds)
+                config.add_builder(builder, scope)
+                builders.append(builder)
+
+        #pylint: disable=protected-access
+        order = yield config._prioritize_builders(_Master(builders),
+                                                  builders[1:])
+        self.assertEqual(['tools', 'gate'], [it.name for it in order])
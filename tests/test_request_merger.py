@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014—2016 Dontnod Entertainment
+
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+''' Build requests merge strategies tests '''
+
+import itertools
+
+from buildbot.changes.changes import Change
+from buildbot.sourcestamp import SourceStamp
+from twisted.trial import unittest
+
+import ebb
+
+#pylint: disable=protected-access
+
+_IDS = itertools.count(1)
+
+class _Request(object):
+    ''' Mimics the buildbot build request attributes read when merging '''
+    def __init__(self, *sources):
+        self.id = next(_IDS) #pylint: disable=invalid-name
+        self.sources = dict((it.codebase, it) for it in sources)
+
+def _get_source(revision=None, changes=0, codebase='', branch='main',
+                patch=None):
+    changes = [Change('author', ['file'], 'comment', branch=branch,
+                      revision='r%s' % it)
+               for it in range(changes)]
+    # Changes are sorted by their database number
+    for number, change in enumerate(changes):
+        change.number = number
+    return SourceStamp(branch=branch, revision=revision, patch=patch,
+                       changes=changes, codebase=codebase)
+
+class RequestMergerTest(unittest.TestCase):
+    ''' Checks which requests each strategy merges '''
+    def test_pinned_revisions(self):
+        ''' Forced revisions are only merged with the same revision, unless
+            merging per branch '''
+        branch = ebb._get_request_merger('branch', None)
+        newest = ebb._get_request_merger('newest_revision', None)
+        pinned = _Request(_get_source('r1'))
+        same_pinned = _Request(_get_source('r1'))
+        other_pinned = _Request(_get_source('r2'))
+        unpinned = _Request(_get_source(changes=1))
+
+        self.assertTrue(branch(None, pinned, other_pinned))
+        self.assertTrue(branch(None, pinned, unpinned))
+        self.assertTrue(newest(None, pinned, same_pinned))
+        self.assertFalse(newest(None, pinned, other_pinned))
+        self.assertFalse(newest(None, unpinned, pinned))
+        self.assertTrue(newest(None, unpinned,
+                               _Request(_get_source(changes=2))))
+
+    def test_patches(self):
+        ''' Requests with a patch are never merged '''
+        patched = _Request(_get_source(patch=(1, 'diff')))
+        for name in ['branch', 'newest_revision', 'max_changes']:
+            merger = ebb._get_request_merger(name, 10)
+            self.assertFalse(merger(None, patched, _Request(_get_source())))
+            self.assertFalse(merger(None, _Request(_get_source()), patched))
+
+    def test_codebases(self):
+        ''' Requests are merged when they build the same codebases and
+            branches '''
+        merger = ebb._get_request_merger('branch', None)
+        request = _Request(_get_source(codebase='a'), _get_source(codebase='b'))
+
+        self.assertTrue(merger(None, request,
+                               _Request(_get_source(codebase='a'),
+                                        _get_source(codebase='b'))))
+        self.assertFalse(merger(None, request,
+                                _Request(_get_source(codebase='a'))))
+        self.assertFalse(merger(None, request,
+                                _Request(_get_source(codebase='a'),
+                                         _get_source(codebase='c'))))
+        self.assertFalse(merger(None, request,
+                                _Request(_get_source(codebase='a'),
+                                         _get_source(codebase='b',
+                                                     branch='other'))))
+
+    def test_max_changes(self):
+        ''' Requests are merged until the merged changes exceed the cap '''
+        merger = ebb._get_request_merger('max_changes', 4)
+        request = _Request(_get_source(changes=2))
+        others = [_Request(_get_source(changes=1)) for _ in range(3)]
+
+        self.assertEqual([True, True, False],
+                         [merger(None, request, it) for it in others])
+
+    def test_max_changes_checked_again(self):
+        ''' Changes are counted again when the same cached request is merged
+            on a later pass, as when its build failed to start '''
+        merger = ebb._get_request_merger('max_changes', 4)
+        request = _Request(_get_source(changes=2))
+        others = [_Request(_get_source(changes=1)) for _ in range(3)]
+
+        for _ in range(2):
+            self.assertEqual([True, True, False],
+                             [merger(None, request, it) for it in others])
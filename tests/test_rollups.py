@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014—2016 Dontnod Entertainment
+
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+''' elastic_bot rollups and quantile sketch tests '''
+
+import datetime
+import os
+import random
+import sys
+
+from twisted.trial import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir,
+                                'utilities'))
+#pylint: disable=import-error,wrong-import-position
+import elastic_bot
+
+#pylint: disable=protected-access
+
+class _Sink(object):
+    ''' Keeps the last document written for each id '''
+    def __init__(self):
+        self.documents = {}
+
+    def write(self, actions):
+        ''' Accepts all actions '''
+        for action in actions:
+            self.documents[action['_id']] = action['_source']
+            yield True, action['_id'], None
+
+class QuantileSketchTest(unittest.TestCase):
+    ''' Checks quantiles approximated by the sketch '''
+    def test_relative_error(self):
+        ''' Quantiles are within the sketch relative accuracy of the exact
+            ones '''
+        generator = random.Random(0)
+        values = [generator.lognormvariate(3, 2) for _ in range(10000)]
+        sketch = elastic_bot._QuantileSketch()
+        for value in values:
+            sketch.add(value)
+        values.sort()
+
+        accuracy = elastic_bot._QuantileSketch._RELATIVE_ACCURACY
+        for quantile in [0, 0.01, 0.25, 0.5, 0.9, 0.99, 1]:
+            exact = values[int(quantile * (len(values) - 1))]
+            approximation = sketch.get_quantile(quantile)
+            self.assertTrue(abs(approximation - exact) <= accuracy * exact,
+                            '%s : %s != %s' % (quantile, approximation, exact))
+
+    def test_serialized(self):
+        ''' Sketches are the same once loaded from their dictionary '''
+        sketch = elastic_bot._QuantileSketch()
+        for value in [0, 1, 2, 3, 50]:
+            sketch.add(value)
+        loaded = elastic_bot._QuantileSketch.from_dict(sketch.to_dict())
+
+        self.assertEqual([sketch.get_quantile(it / 10.0) for it in range(11)],
+                         [loaded.get_quantile(it / 10.0) for it in range(11)])
+
+class RollupsTest(unittest.TestCase):
+    ''' Checks daily rollups of indexed builds '''
+    def setUp(self):
+        self._path = os.path.abspath(self.mktemp())
+        self._sink = _Sink()
+
+    def _index(self, builds):
+        rollups = elastic_bot._Rollups(self._path, 'rollups')
+        try:
+            for build_number, duration in builds:
+                start = datetime.datetime(2020, 1, 1, build_number)
+                document = {'buildername' : 'builder',
+                            'buildnumber' : build_number,
+                            'start' : start}
+                rollups.add('step', dict(document, step_name='compile',
+                                         duration=duration - 1))
+                rollups.add('build', dict(document, duration=duration))
+            rollups.flush(self._sink)
+        finally:
+            rollups.close()
+        return self._sink.documents
+
+    def test_quantiles_clamped(self):
+        ''' Quantiles are within the observed durations '''
+        rollup = self._index([(0, 100)])['builder_2020-01-01_build']
+
+        for quantile in [50, 90, 95, 99]:
+            self.assertEqual(100, rollup['duration_p%s' % quantile])
+
+    def test_builds_counted_once(self):
+        ''' Builds indexed again, in the same run or a later one, are counted
+            once '''
+        self._index([(0, 10), (1, 20), (1, 20)])
+        documents = self._index([(1, 20), (2, 30)])
+
+        rollup = documents['builder_2020-01-01_build']
+        self.assertEqual(3, rollup['duration_count'])
+        self.assertEqual(60, rollup['duration_sum'])
+        step_rollup = documents['builder_2020-01-01_step_compile']
+        self.assertEqual(3, step_rollup['duration_count'])
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014—2016 Dontnod Entertainment
+
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+''' Tests of schedulers shared by builders '''
+
+from twisted.trial import unittest
+
+import ebb
+
+class NightlySchedulersTest(unittest.TestCase):
+    ''' Checks nightly schedulers names and staggering '''
+    def _get_schedulers(self, builder_names, **nightly_args):
+        with ebb.Config() as config:
+            ebb.Config.nightly_stagger(2, 15)
+            with ebb.Slave('slave'):
+                ebb.Slave.config('password')
+            for name in builder_names:
+                with ebb.Builder(name) as builder:
+                    builder.trigger_nightly(**nightly_args)
+        buildbot_config = config.build_config()
+        return [(it.name, it.builderNames, it.hour, it.minute)
+                for it in buildbot_config['schedulers']]
+
+    def test_names_independent_of_builders(self):
+        ''' Adding a builder keeps the names of existing schedulers '''
+        schedulers = self._get_schedulers(['a', 'b', 'c'], hour=2, minute=0)
+        self.assertEqual([['a', 'b'], ['c']], [it[1] for it in schedulers])
+
+        added_schedulers = self._get_schedulers(['0', 'a', 'b', 'c'],
+                                                hour=2, minute=0)
+        self.assertEqual([it[0] for it in schedulers],
+                         [it[0] for it in added_schedulers])
+        self.assertTrue(schedulers[1][0].endswith(' batch 1'))
+
+    def test_staggered(self):
+        ''' Batches start one after the other, carrying into hours '''
+        schedulers = self._get_schedulers(['a', 'b', 'c', 'd', 'e'],
+                                          hour=23, minute=30)
+        self.assertEqual([(23, 30), (23, 45), (0, 0)],
+                         [it[2:] for it in schedulers])
+
+    def test_not_staggered_across_days(self):
+        ''' Schedules of given days are not moved to the next day '''
+        schedulers = self._get_schedulers(['a', 'b', 'c', 'd', 'e'],
+                                          hour=23, minute=30, day_of_week=1)
+        self.assertEqual([(23, 30), (23, 45), (23, 30)],
+                         [it[2:] for it in schedulers])
+
+    def test_not_staggered_across_hours(self):
+        ''' Hourly schedules are only staggered within the hour '''
+        schedulers = self._get_schedulers(['a', 'b', 'c', 'd', 'e'],
+                                          minute=40)
+        self.assertEqual([('*', 40), ('*', 55), ('*', 40)],
+                         [it[2:] for it in schedulers])
+
+class ChangeSchedulersTest(unittest.TestCase):
+    ''' Checks single branch schedulers shared by builders '''
+    def _get_schedulers(self, builder_names):
+        with ebb.Config() as config:
+            with ebb.Slave('slave'):
+                ebb.Slave.config('password')
+            ebb.Scope.set('project_name', 'project')
+            for name in builder_names:
+                with ebb.Builder(name) as builder:
+                    builder.trigger_on_change('main/.*')
+        buildbot_config = config.build_config()
+        return [(it.name, it.builderNames)
+                for it in buildbot_config['schedulers']]
+
+    def test_names_independent_of_builders(self):
+        ''' Builders with the same filter share a scheduler, named after the
+            filter only '''
+        schedulers = self._get_schedulers(['a', 'b'])
+        self.assertEqual([['a', 'b']], [it[1] for it in schedulers])
+
+        added_schedulers = self._get_schedulers(['0', 'a', 'b'])
+        self.assertEqual([['0', 'a', 'b']], [it[1] for it in added_schedulers])
+        self.assertEqual(schedulers[0][0], added_schedulers[0][0])
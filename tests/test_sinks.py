@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014—2016 Dontnod Entertainment
+
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+''' elastic_bot file sinks tests '''
+
+import datetime
+import gzip
+import json
+import os
+import sqlite3
+import sys
+
+from twisted.trial import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir,
+                                'utilities'))
+#pylint: disable=import-error,wrong-import-position
+import elastic_bot
+
+#pylint: disable=protected-access
+
+_START = datetime.datetime(2020, 1, 2, 3, 4, 5)
+
+class FileSinksTest(unittest.TestCase):
+    ''' Checks documents written by sinks can be read back '''
+    def setUp(self):
+        self._directory = os.path.abspath(self.mktemp())
+        os.makedirs(self._directory)
+
+    def _write(self, sink, actions):
+        try:
+            results = list(sink.write(actions))
+            sink.flush()
+        finally:
+            sink.close()
+        self.assertEqual([(True, it['_id'], None) for it in actions], results)
+
+    def _check_ndjson(self, path, open_file):
+        actions = _get_actions()
+        self._write(elastic_bot._NdjsonSink(path), actions[:1])
+        self._write(elastic_bot._NdjsonSink(path), actions[1:])
+
+        with open_file(path, 'rb') as ndjson_file:
+            documents = [json.loads(it) for it in ndjson_file]
+        self.assertEqual(['builder_1_0', 'builder_1'],
+                         [it['_id'] for it in documents])
+        self.assertEqual(['step', 'build'], [it['_type'] for it in documents])
+        self.assertEqual(_START.isoformat(), documents[1]['start'])
+        self.assertEqual({'a' : 1}, documents[1]['extra'])
+
+    def test_ndjson(self):
+        ''' Documents are appended, a line each '''
+        self._check_ndjson(os.path.join(self._directory, 'out.ndjson'), open)
+
+    def test_ndjson_gzip(self):
+        ''' Files ending with .gz are compressed '''
+        self._check_ndjson(os.path.join(self._directory, 'out.ndjson.gz'),
+                           gzip.open)
+
+    def test_sqlite(self):
+        ''' Documents are stored in columns and as JSON, and replaced when
+            written again '''
+        path = os.path.join(self._directory, 'out.sqlite')
+        actions = _get_actions()
+        self._write(elastic_bot._SqliteSink(path), actions)
+        actions[1]['_source']['duration'] = 12
+        self._write(elastic_bot._SqliteSink(path), actions[1:])
+
+        connection = sqlite3.connect(path)
+        try:
+            rows = connection.execute('SELECT id, type, buildername, '
+                                      'buildnumber, step_name, start, '
+                                      'duration, document FROM documents '
+                                      'ORDER BY id').fetchall()
+        finally:
+            connection.close()
+        self.assertEqual([('builder_1', 'build', 'builder', 1, None,
+                           _START.isoformat(), 12),
+                          ('builder_1_0', 'step', 'builder', 1, 'compile',
+                           _START.isoformat(), 5)],
+                         [it[:-1] for it in rows])
+        self.assertEqual({'a' : 1}, json.loads(rows[0][-1])['extra'])
+
+class CheckpointPathTest(unittest.TestCase):
+    ''' Checks exports don't share the Elasticsearch checkpoint '''
+    def _load_arguments(self, *arguments):
+        self.patch(sys, 'argv', ['elastic_bot.py'] + list(arguments))
+        return elastic_bot._load_arguments()
+
+    def test_default(self):
+        ''' The default checkpoint depends on the sink output '''
+        self.assertEqual('elastic_bot_checkpoint.json',
+                         self._load_arguments().checkpoint)
+        self.assertEqual(os.path.join('out', 'docs.ndjson.checkpoint.json'),
+                         self._load_arguments('--sink', 'ndjson', '--output',
+                                              'out/docs.ndjson').checkpoint)
+        self.assertEqual('parts.checkpoint.json',
+                         self._load_arguments('--sink', 'columnar',
+                                              '--output',
+                                              'parts/').checkpoint)
+
+    def test_explicit(self):
+        ''' --checkpoint is used by all sinks '''
+        self.assertEqual('other.json',
+                         self._load_arguments('--sink', 'sqlite', '--output',
+                                              'out.sqlite', '--checkpoint',
+                                              'other.json').checkpoint)
+
+def _get_actions():
+    build = {'buildername' : 'builder', 'buildnumber' : 1, 'start' : _START,
+             'duration' : 10, 'extra' : {'a' : 1}}
+    step = dict(build, step_name='compile', step_number=0, duration=5)
+    return [{'_index' : 'buildbot-2020.01', '_type' : 'step',
+             '_id' : 'builder_1_0', '_source' : step},
+            {'_index' : 'buildbot-2020.01', '_type' : 'build',
+             '_id' : 'builder_1', '_source' : build}]
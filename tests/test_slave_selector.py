@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014—2016 Dontnod Entertainment
+
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+''' Slave selector tests '''
+
+from buildbot.status import results
+from twisted.trial import unittest
+
+import ebb
+
+#pylint: disable=invalid-name
+
+class _Named(object):
+    ''' Mimics buildbot builders, builds and slave builders attributes read
+        by the slave selector '''
+    def __init__(self, name, slave=None, busy=False):
+        self.name = name
+        self.slave = slave
+        self._busy = busy
+
+    def getSlavename(self):
+        ''' Slave of a build '''
+        return self.name
+
+    def isBusy(self):
+        ''' Whether a slave builder is running a build '''
+        return self._busy
+
+class _Slave(object):
+    ''' Mimics the buildbot slave attributes read by the slave selector '''
+    def __init__(self, slavename, running_builds=0, max_builds=None):
+        self.slavename = slavename
+        self.max_builds = max_builds
+        self.slavebuilders = dict(('builder-%s' % it, _Named(None, busy=True))
+                                  for it in range(running_builds))
+
+def _get_slave_builders(*slaves):
+    return [_Named(None, it) for it in slaves]
+
+class SlaveSelectorTest(unittest.TestCase):
+    ''' Checks the slave chosen for a builder '''
+    def setUp(self):
+        self._now = 1000.0
+        self.patch(ebb.time, 'time', lambda: self._now)
+
+    def _select(self, selector, builder_name, *slaves):
+        slave_builders = _get_slave_builders(*slaves)
+        return selector(_Named(builder_name), slave_builders).slave.slavename
+
+    def test_least_loaded(self):
+        ''' Without previous builds, the least loaded slave is chosen '''
+        selector = ebb.SlaveSelector()
+        self.assertEqual('b', self._select(selector, 'builder',
+                                           _Slave('a', 2, 4),
+                                           _Slave('b', 1, 4),
+                                           _Slave('c', 1, 2)))
+        self.assertEqual(None, selector(_Named('builder'), []))
+
+    def test_last_slave_preferred(self):
+        ''' The slave that last built a builder is chosen, even if more
+            loaded '''
+        selector = ebb.SlaveSelector()
+        selector.buildStarted('builder', _Named('b'))
+        selector.buildStarted('other', _Named('a'))
+        slaves = [_Slave('a'), _Slave('b', 1)]
+
+        self.assertEqual('b', self._select(selector, 'builder', *slaves))
+        self.assertEqual('a', self._select(selector, 'unknown', *slaves))
+
+    def test_failures_demoted(self):
+        ''' Slaves with recent exceptions or retries are avoided until the
+            failure timeout, failed builds are not counted '''
+        selector = ebb.SlaveSelector(failure_timeout=60)
+        selector.buildStarted('builder', _Named('a'))
+        selector.buildFinished('builder', _Named('a'), results.FAILURE)
+        slaves = [_Slave('a', 1), _Slave('b')]
+        self.assertEqual('a', self._select(selector, 'builder', *slaves))
+
+        selector.buildFinished('builder', _Named('a'), results.EXCEPTION)
+        self.assertEqual('b', self._select(selector, 'builder', *slaves))
+        selector.buildFinished('builder', _Named('b'), results.RETRY)
+        selector.buildFinished('builder', _Named('b'), results.RETRY)
+        self.assertEqual('a', self._select(selector, 'builder', *slaves))
+
+        self._now += 61
+        self.assertEqual('a', self._select(selector, 'builder', _Slave('b'),
+                                           _Slave('a', 1)))
+
+    def test_bounded_state(self):
+        ''' Only the last started builders and the last recent failures of
+            each slave are remembered '''
+        #pylint: disable=protected-access
+        selector = ebb.SlaveSelector(failure_timeout=60, max_builders=2)
+        for name in ['builder-1', 'builder-2', 'builder-1', 'builder-3']:
+            selector.buildStarted(name, _Named('a'))
+        for _ in range(ebb.SlaveSelector._MAX_FAILURES + 5):
+            selector.buildFinished('builder-1', _Named('a'), results.RETRY)
+
+        self.assertEqual(['builder-1', 'builder-3'],
+                         list(selector._last_slaves))
+        self.assertEqual(ebb.SlaveSelector._MAX_FAILURES,
+                         len(selector._failures['a']))
+
+        self._now += 61
+        selector.buildFinished('builder-1', _Named('b'), results.RETRY)
+        self.assertEqual(['b'], list(selector._failures))
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014—2016 Dontnod Entertainment
+
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+''' Trigger step tests, on built configs '''
+
+from twisted.trial import unittest
+
+import ebb
+
+class TriggerTest(unittest.TestCase):
+    ''' Checks buildbot Trigger steps and schedulers created by ebb '''
+    def _build_config(self, declare):
+        with ebb.Config() as config:
+            with ebb.Slave('slave'):
+                ebb.Slave.config('password')
+            declare()
+        return config.build_config()
+
+    def _get_steps(self, buildbot_config, builder_name):
+        for builder in buildbot_config['builders']:
+            if builder.name == builder_name:
+                return builder.factory.steps
+        self.fail('Builder %s not found' % builder_name)
+
+    def test_set_properties_interpolated(self):
+        ''' trigger_set_properties are interpolated, and the parent build is
+            added to them '''
+        def _declare():
+            with ebb.Builder('parent'):
+                with ebb.Trigger('start', 'child'):
+                    ebb.Scope.set('trigger_set_properties',
+                                  {'origin' : '{builder_name}'})
+            with ebb.Builder('child'):
+                pass
+
+        buildbot_config = self._build_config(_declare)
+        steps = self._get_steps(buildbot_config, 'parent')
+        set_properties = steps[0].kwargs['set_properties']
+        self.assertEqual('parent', set_properties['origin'])
+        self.assertEqual('start', set_properties['parent_stepname'])
+
+        scheduler_names = steps[0].kwargs['schedulerNames']
+        schedulers = [it for it in buildbot_config['schedulers']
+                      if it.name in scheduler_names]
+        self.assertEqual([['child']], [it.builderNames for it in schedulers])
+
+    def test_locks_not_inherited(self):
+        ''' Triggered builders don't inherit locks held by the triggering
+            build, but take those declared for them '''
+        def _declare():
+            ebb.Builder.add_lock('global')
+            with ebb.Builder('parent'):
+                ebb.Builder.add_lock('parent')
+                ebb.Step.add_lock('parent_step')
+                with ebb.Trigger('start'):
+                    ebb.Step.add_lock('trigger')
+                    with ebb.Trigger.builder('child'):
+                        ebb.Builder.add_lock('child')
+                        with ebb.Command('build', 'make'):
+                            pass
+
+        buildbot_config = self._build_config(_declare)
+        builders = dict((it.name, it) for it in buildbot_config['builders'])
+        self.assertEqual(['global', 'parent'],
+                         [it.lockid.name for it in builders['parent'].locks])
+        self.assertEqual(['child'],
+                         [it.lockid.name for it in builders['child'].locks])
+        child_steps = self._get_steps(buildbot_config, 'child')
+        self.assertEqual(None, child_steps[0].kwargs.get('locks'))
+
+    def test_held_lock_rejected(self):
+        ''' Taking a lock held by the triggering build is an error '''
+        def _declare():
+            with ebb.Builder('parent'):
+                ebb.Builder.add_lock('shared')
+                with ebb.Trigger.builder('child'):
+                    ebb.Builder.add_lock('shared')
+
+        self.assertRaises(Exception, self._build_config, _declare)
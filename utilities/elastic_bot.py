@@ -23,24 +23,112 @@
 ''' Gathers buildbot build statistics to an ElasticSerach database '''
 
 import argparse
+import bisect
+import collections
 import cPickle
 import datetime
+import gzip
+import itertools
+import json
 import logging
+import math
+import multiprocessing
+import multiprocessing.pool
 import os
-import re
+import sqlite3
 import sys
+import threading
+import time
 
 import dateutil.tz
 import pytz
 
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+try:
+    from os import scandir as _scandir
+except ImportError:
+    try:
+        from scandir import scandir as _scandir
+    except ImportError:
+        _scandir = None
+
 import elasticsearch
 import elasticsearch.connection
 import elasticsearch.helpers
 
-import buildbot.status.builder
-
 _LOGGER = logging.getLogger('elastic-bot')
 
+_UTC = dateutil.tz.tzutc()
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=_UTC)
+
+# Same as buildbot.status.results.Results, so that buildbot isn't needed
+_RESULTS = ['success', 'warnings', 'failure', 'skipped', 'exception', 'retry',
+            'cancelled']
+
+# Build properties copied in step documents when --slim-steps is set, the
+# others are only stored in build documents
+_STEP_JOIN_PROPERTIES = ['buildername', 'buildnumber', 'slavename', 'branch']
+
+# Number of unpickling tasks queued per worker process, bounding the memory
+# used by documents waiting to be uploaded
+_PENDING_TASKS_PER_PROCESS = 16
+
+# Number of documents sent per bulk request. The checkpoint is saved after each
+# acknowledged chunk
+_CHUNK_SIZE = 500
+
+# Delays in seconds before retrying a failed bulk request, doubled on each
+# retry
+_INITIAL_BACKOFF = 2
+_MAX_BACKOFF = 300
+
+# Number of builders fetched per composite aggregation page when rebuilding the
+# checkpoint from Elasticsearch
+_CHECKPOINT_PAGE_SIZE = 500
+
+# Documents are stored in monthly indices named <index>-YYYY.MM, matched by an
+# index template adding them to the <index> alias queries go through
+_INDEX_MONTH_FORMAT = '%Y.%m'
+_MAPPING_TYPE = 'doc'
+_INDEX_SETTINGS = {
+    # A month of builds is small enough to fit in one shard
+    'number_of_shards' : 1,
+}
+_MAPPING = {
+    'dynamic_templates' : [
+        # Sketches are only read back from the rollups state file
+        {'sketches' : {'match' : '*_sketch',
+                       'mapping' : {'type' : 'object', 'enabled' : False}}},
+        # Properties are filtered and aggregated on, never searched as text
+        {'strings' : {'match_mapping_type' : 'string',
+                      'mapping' : {'type' : 'keyword',
+                                   'ignore_above' : 1024}}},
+    ],
+    'properties' : {
+        'type' : {'type' : 'keyword'},
+        'blamelist' : {'type' : 'text',
+                       'fields' : {'keyword' : {'type' : 'keyword',
+                                                'ignore_above' : 1024}}},
+        'buildnumber' : {'type' : 'long'},
+        'step_number' : {'type' : 'long'},
+        'start' : {'type' : 'date'},
+        'end' : {'type' : 'date'},
+        'duration' : {'type' : 'double'},
+        'waiting_duration' : {'type' : 'double'},
+        'total_duration' : {'type' : 'double'},
+    }
+}
+
 def main():
     ''' Entry Point '''
     args = _load_arguments()
@@ -49,25 +137,117 @@ def main():
     tz_name = args.buildbot_timezone
     timezone = dateutil.tz.tzlocal() if not tz_name else pytz.timezone(tz_name)
 
-    database = elasticsearch.Elasticsearch(args.nodes)
-    actions = _get_bulk_actions(database,
-                                args.index,
+    database = None
+    if args.sink == 'elasticsearch' or args.rebuild_checkpoint:
+        database = elasticsearch.Elasticsearch(args.nodes)
+
+    if args.sink == 'elasticsearch':
+        _setup_indices(database, args)
+
+    if args.overwrite:
+        checkpoint = _Checkpoint()
+    elif database is not None and (args.rebuild_checkpoint or
+                                   not os.path.exists(args.checkpoint)):
+        checkpoint = _Checkpoint(_get_last_builds(database, args.index))
+    elif os.path.exists(args.checkpoint):
+        checkpoint = _Checkpoint.load(args.checkpoint)
+    else:
+        checkpoint = _Checkpoint()
+    checkpoint.save(args.checkpoint)
+
+    sink = _create_sink(args, database)
+    analyses = _create_analyses(args)
+
+    # Watch before the first pass, so that builds written meanwhile are caught
+    watch = _watch_builds(args) if args.follow else None
+
+    builders = {}
+    errors = collections.Counter()
+    actions = _get_bulk_actions(args.index,
                                 args.builders_dir,
-                                args.overwrite,
-                                timezone)
+                                checkpoint,
+                                timezone,
+                                args.slim_steps,
+                                args.processes,
+                                builders,
+                                args.builder_cache,
+                                errors)
+    try:
+        error = _index_actions(sink, actions, checkpoint, analyses, args)
 
-    bulk = elasticsearch.helpers.parallel_bulk
-    error = False
-    for success, result in bulk(database, actions, thread_count=args.threads):
-        doc_id = result['index']['_id']
-        if not success:
-            _LOGGER.error('Error indexing object %s : %s', doc_id, result)
-            error = True
-        else:
-            _LOGGER.info('Indexed item %s', doc_id)
+        if watch is not None:
+            _follow(sink, args, timezone, builders, checkpoint, analyses,
+                    watch, errors)
+    finally:
+        for analysis in analyses:
+            analysis.close()
+        sink.close()
+
+    if errors:
+        _LOGGER.error('%s builders and %s builds could not be read, see above '
+                      'errors', errors['builders'], errors['builds'])
+        error = True
 
     return 1 if error else 0
 
+def _index_actions(sink, actions, checkpoint, analyses, args):
+    # Sink results come back in the order actions were sent, this queue
+    # matches each result with the build it belongs to
+    sent_documents = collections.deque()
+    actions = _track_documents(actions, sent_documents)
+
+    error = False
+    is_checkpoint_dirty = False
+    # Step documents come before their build document. They are given to
+    # analyses with it, once all documents of the build were accepted
+    build_steps = []
+    is_build_failed = False
+    results = sink.write(actions)
+    try:
+        for result_count, (success, doc_id, result) in enumerate(results, 1):
+            action = sent_documents.popleft()
+            doc_type, document = action['_type'], action['_source']
+            if not success:
+                _LOGGER.error('Error indexing object %s : %s', doc_id, result)
+                error = True
+            else:
+                _LOGGER.info('Indexed item %s', doc_id)
+
+            if doc_type == 'step':
+                build_steps.append(document)
+                is_build_failed = is_build_failed or not success
+            elif doc_type == 'build':
+                # Failed builds stay pending in the checkpoint, and are
+                # indexed again on next run
+                if success and not is_build_failed:
+                    for analysis in analyses:
+                        for step in build_steps:
+                            analysis.add('step', step)
+                        analysis.add(doc_type, document)
+                    checkpoint.set_done(document.get('buildername'),
+                                        document.get('buildnumber'))
+                    is_checkpoint_dirty = True
+                build_steps = []
+                is_build_failed = False
+
+            if is_checkpoint_dirty and result_count % _CHUNK_SIZE == 0:
+                _save_progress(sink, checkpoint, analyses, args)
+                is_checkpoint_dirty = False
+    finally:
+        # Even when interrupted, save acknowledged builds so that the next run
+        # resumes from there
+        if is_checkpoint_dirty:
+            _save_progress(sink, checkpoint, analyses, args)
+
+    return error
+
+def _save_progress(sink, checkpoint, analyses, args):
+    # Analyses skip builds they already processed, so they are saved first
+    for analysis in analyses:
+        analysis.flush(sink)
+    sink.flush()
+    checkpoint.save(args.checkpoint)
+
 def _init_logging(verbose):
     _LOGGER.setLevel(logging.DEBUG if verbose else logging.INFO)
     handler = logging.StreamHandler(sys.stdout)
@@ -98,14 +278,61 @@ def _load_arguments():
                         nargs='*',
                         help='Elasticsearch database hosts')
 
+    parser.add_argument('--sink',
+                        choices=sorted(_SINKS),
+                        default='elasticsearch',
+                        help=('Where to write documents. ndjson, sqlite and '
+                              'columnar sinks write to --output'))
+
+    parser.add_argument('--output',
+                        metavar='<path>',
+                        default=None,
+                        help=('Output file of the ndjson (gzipped if it ends '
+                              'with .gz) and sqlite sinks, or output '
+                              'directory of the columnar sink, where it '
+                              'writes a Parquet file per chunk of documents. '
+                              'Emptied by --overwrite'))
+
     parser.add_argument('--index',
                         metavar='<index>',
                         default='buildbot',
-                        help='Elasticsearch index where to store statistics')
+                        help=('Elasticsearch alias where to store statistics, '
+                              'documents are written to monthly '
+                              '<index>-YYYY.MM indices'))
+
+    parser.add_argument('--retention-months',
+                        metavar='<months>',
+                        type=int,
+                        default=None,
+                        help=('Deletes monthly indices older than this '
+                              'number of months on startup'))
 
     parser.add_argument('--overwrite',
                         action='store_true',
-                        help=('Overwrites builds already indexed'))
+                        help=('Overwrites builds already indexed, and resets '
+                              'the checkpoint'))
+
+    parser.add_argument('--checkpoint',
+                        metavar='<file>',
+                        default=None,
+                        help=('File where the last indexed build of each '
+                              'builder is stored. Defaults to '
+                              'elastic_bot_checkpoint.json for the '
+                              'elasticsearch sink, and to '
+                              '<output>.checkpoint.json for others, so that '
+                              'exports don\'t skip builds of the next '
+                              'Elasticsearch run'))
+
+    parser.add_argument('--builder-cache',
+                        metavar='<file>',
+                        default='elastic_bot_builders.json',
+                        help=('File caching builder names, so that builder '
+                              'pickles are only loaded when they change'))
+
+    parser.add_argument('--rebuild-checkpoint',
+                        action='store_true',
+                        help=('Rebuilds the checkpoint file from builds '
+                              'already stored in Elasticsearch'))
 
     parser.add_argument('--threads',
                         '-t',
@@ -113,153 +340,1407 @@ def _load_arguments():
                         default=1,
                         help=('Number of database threads to create.'))
 
+    parser.add_argument('--max-chunk-bytes',
+                        metavar='<bytes>',
+                        type=int,
+                        default=10 * 1024 * 1024,
+                        help=('Maximum size of a bulk request sent to '
+                              'Elasticsearch'))
+
+    parser.add_argument('--max-retries',
+                        metavar='<count>',
+                        type=int,
+                        default=5,
+                        help=('Number of times a bulk request is retried on '
+                              'connection errors or when the cluster is '
+                              'overloaded'))
+
+    parser.add_argument('--dead-letter',
+                        metavar='<file>',
+                        default='elastic_bot_rejected.ndjson',
+                        help=('File where documents rejected by Elasticsearch '
+                              'are written'))
+
+    parser.add_argument('--processes',
+                        '-p',
+                        type=int,
+                        default=1,
+                        help=('Number of processes unpickling builds and '
+                              'creating documents.'))
+
+    parser.add_argument('--follow',
+                        '-f',
+                        action='store_true',
+                        help=('Keeps running after indexing existing builds, '
+                              'indexing new builds as soon as they are '
+                              'written'))
+
+    parser.add_argument('--follow-interval',
+                        metavar='<seconds>',
+                        type=float,
+                        default=5,
+                        help=('Maximum delay before indexing new builds in '
+                              'follow mode'))
+
+    parser.add_argument('--rollups',
+                        metavar='<file>',
+                        default=None,
+                        help=('Maintains daily statistics per builder and '
+                              'step in a rollup index, keeping their state '
+                              'in this SQLite file'))
+
+    parser.add_argument('--rollup-index',
+                        metavar='<index>',
+                        default=None,
+                        help=('Index where to store rollups, defaults to '
+                              '<index>_rollups'))
+
+    parser.add_argument('--chains',
+                        metavar='<file>',
+                        default=None,
+                        help=('Links builds started by Trigger steps to their '
+                              'parent, and indexes critical path and queue '
+                              'time of each chain, keeping their state in '
+                              'this SQLite file'))
+
+    parser.add_argument('--slim-steps',
+                        action='store_true',
+                        help=('Only copy %s build properties to step documents'
+                              % ', '.join(_STEP_JOIN_PROPERTIES)))
+
     parser.add_argument('--buildbot-timezone',
                         type=str,
                         default=None,
                         help=('Timezone of timestamps stored in buildbot pickles'))
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.sink != 'elasticsearch' and args.output is None:
+        parser.error('--output is required by the %s sink' % args.sink)
+    if args.checkpoint is None:
+        args.checkpoint = _get_checkpoint_path(args.sink, args.output)
+    return args
 
-def _get_bulk_actions(database, index, builders_dir, overwrite, timezone):
+def _get_checkpoint_path(sink, output):
+    if sink == 'elasticsearch':
+        return 'elastic_bot_checkpoint.json'
+    return os.path.normpath(output) + '.checkpoint.json'
+
+def _get_bulk_actions(index, builders_dir, checkpoint, timezone, slim_steps,
+                      processes, builders, builder_cache_path, errors):
+    pool = multiprocessing.Pool(processes) if processes > 1 else None
+    max_pending = processes * _PENDING_TASKS_PER_PROCESS
     try:
-        last_builds = {} if overwrite else _get_last_builds(database, index)
+        tasks = _get_build_tasks(index, builders_dir, checkpoint, timezone,
+                                 slim_steps, pool, max_pending, builders,
+                                 builder_cache_path, errors)
+        # Results come back in submission order, so builds of a builder are
+        # always yielded in increasing build number
+        build_actions = _imap_bounded(pool, _get_build_actions, tasks,
+                                      max_pending)
+        for action in _flatten_actions(build_actions, checkpoint, errors):
+            yield action
+    #pylint: disable=broad-except
+    except Exception as ex:
+        _LOGGER.exception('An error occured during build informations '
+                          'gathering %s', ex)
+        errors['fatal'] += 1
+    finally:
+        if pool is not None:
+            pool.terminate()
 
-        for builder_name, builder_dir in _discover_builders(builders_dir):
-            if builder_name in last_builds:
-                last_build = last_builds[builder_name]
-            else:
-                last_build = -1
+def _get_build_tasks(index, builders_dir, checkpoint, timezone, slim_steps,
+                     pool, max_pending, builders, builder_cache_path, errors):
+    discovered_builders = _discover_builders(builders_dir, pool, max_pending,
+                                             builder_cache_path, errors)
+    for builder_name, builder_dir in discovered_builders:
+        builders[builder_dir] = builder_name
+        build_paths = _list_build_paths(builder_name, builder_dir, checkpoint,
+                                        errors)
+        for build_pickle_path in build_paths:
+            yield (index, builder_name, build_pickle_path, timezone,
+                   slim_steps)
 
-            for build in _load_builds(builder_name, builder_dir, last_build):
-                build_id = '_'.join([builder_name, str(build.number)])
-                build_properties = _get_build_properties(build, timezone)
-                _LOGGER.debug('Created build %s:%s document',
-                              builder_name,
-                              build.number)
-                for key, value in build_properties.iteritems():
-                    _LOGGER.debug('%s : %s', key, value)
-
-                for step in build.steps:
-                    if step.started is None:
-                        continue
-
-                    step_id = '_'.join([build_id, str(step.step_number)])
-                    step_properties = _get_step_properties(build, step, timezone)
-                    _LOGGER.debug('Created step %s:%s:%s document',
-                                  builder_name,
-                                  build.number,
-                                  step.step_number)
-                    for key, value in step_properties.iteritems():
-                        _LOGGER.debug('%s : %s', key, value)
-                    yield _get_action(index, 'step', step_id, step_properties)
-
-                yield _get_action(index, 'build', build_id, build_properties)
-
-                _LOGGER.debug('Loaded build %s:%s', builder_name, build.number)
+def _list_build_paths(builder_name, builder_dir, checkpoint, errors):
+    try:
+        return list(_get_build_paths(builder_name, builder_dir, checkpoint))
     #pylint: disable=broad-except
     except Exception as ex:
-        _LOGGER.error('An error occured during build informations gathering %s',
-                      ex)
+        _LOGGER.error('Error listing builds of %s in %s : %s. This builder '
+                      'will be ignored.', builder_name, builder_dir, ex)
+        errors['builders'] += 1
+        return []
+
+def _flatten_actions(build_actions, checkpoint, errors):
+    for builder_name, build_pickle_path, actions in build_actions:
+        if actions is None:
+            # Unreadable builds are ignored rather than read again each run
+            build_number = int(os.path.basename(build_pickle_path))
+            checkpoint.set_done(builder_name, build_number)
+            errors['builds'] += 1
+            continue
+        for action in actions:
+            yield action
+
+def _follow(sink, args, timezone, builders, checkpoint, analyses, watch,
+            errors):
+    _LOGGER.info('Following builds in %s', args.builders_dir)
+    for build_paths in watch:
+        if build_paths is None:
+            tasks = _get_build_tasks(args.index, args.builders_dir,
+                                     checkpoint, timezone, args.slim_steps,
+                                     None, 1, builders, args.builder_cache,
+                                     errors)
+        else:
+            tasks = _get_follow_tasks(args.index, builders, checkpoint,
+                                      timezone, args.slim_steps, build_paths,
+                                      args.builder_cache)
+        build_actions = (_get_build_actions(*task) for task in tasks)
+        actions = _flatten_actions(build_actions, checkpoint, errors)
+        _index_actions(sink, actions, checkpoint, analyses, args)
+
+def _get_follow_tasks(index, builders, checkpoint, timezone, slim_steps,
+                      build_paths, builder_cache_path):
+    builds = []
+    for build_pickle_path in build_paths:
+        builder_dir, file_name = os.path.split(build_pickle_path)
+        if file_name != 'builder' and not file_name.isdigit():
+            continue
+
+        builder_name = _get_builder_name(builders, builder_dir,
+                                         builder_cache_path)
+        if builder_name is None or file_name == 'builder':
+            continue
+
+        build_number = int(file_name)
+        if not checkpoint.should_index(builder_name, build_number):
+            continue
+
+        builds.append((builder_name, build_number, build_pickle_path))
+
+    for builder_name, build_number, build_pickle_path in sorted(builds):
+        checkpoint.set_listed(builder_name, build_number)
+        yield index, builder_name, build_pickle_path, timezone, slim_steps
+
+def _get_builder_name(builders, builder_dir, builder_cache_path):
+    if builder_dir not in builders:
+        builder_pickle_path = os.path.join(builder_dir, 'builder')
+        if not os.path.isfile(builder_pickle_path):
+            return None
+        builder_name = _load_builder_name(builder_pickle_path)
+        if builder_name is None:
+            return None
+        _LOGGER.info('Found new builder %s in %s', builder_name, builder_dir)
+        builders[builder_dir] = builder_name
+        _cache_builder_name(builder_cache_path, builder_dir, builder_name)
+
+    return builders[builder_dir]
+
+def _cache_builder_name(builder_cache_path, builder_dir, builder_name):
+    ''' Adds a builder found while following builds to the cache read by
+        _discover_builders '''
+    if builder_cache_path is None:
+        return
+
+    builder_cache = {}
+    if os.path.exists(builder_cache_path):
+        builder_cache = _load_json(builder_cache_path)
+    builder_stat = os.stat(os.path.join(builder_dir, 'builder'))
+    builder_cache[builder_dir] = [builder_name, builder_stat.st_mtime,
+                                  builder_stat.st_size]
+    _save_json(builder_cache_path, builder_cache)
+
+def _watch_builds(args):
+    ''' Yields lists of written build pickles paths, or None when all builders
+        should be scanned again '''
+    builders_dir = os.path.normpath(os.path.abspath(args.builders_dir))
+    if pyinotify is None:
+        _LOGGER.warn('pyinotify is not available, polling builders every %ss',
+                     args.follow_interval)
+        return _poll_builds(args.follow_interval)
+
+    # Buildbot writes build pickles to a temporary file, then renames it
+    watch_manager = pyinotify.WatchManager()
+    mask = pyinotify.IN_MOVED_TO | pyinotify.IN_CLOSE_WRITE
+    watch_manager.add_watch(builders_dir, mask, rec=True, auto_add=True)
+    return _read_build_events(watch_manager, args.follow_interval)
+
+def _read_build_events(watch_manager, interval):
+    events = []
+    notifier = pyinotify.Notifier(watch_manager,
+                                  default_proc_fun=events.append)
+    while True:
+        if notifier.check_events(timeout=int(interval * 1000)):
+            notifier.read_events()
+            notifier.process_events()
+
+        if not events:
+            continue
+
+        if any(event.mask & pyinotify.IN_Q_OVERFLOW for event in events):
+            _LOGGER.warn('Inotify queue overflowed, scanning all builders')
+            build_paths = None
+        else:
+            build_paths = [event.pathname for event in events]
+        del events[:]
+        yield build_paths
+
+def _poll_builds(interval):
+    while True:
+        time.sleep(interval)
+        yield None
+
+def _imap_bounded(pool, func, tasks, max_pending):
+    ''' Ordered and lazy Pool.imap, keeping at most max_pending tasks in
+        flight so that results don't pile up when the consumer is slower '''
+    if pool is None:
+        for args in tasks:
+            yield func(*args)
+        return
+
+    pending = collections.deque()
+    for args in tasks:
+        pending.append(pool.apply_async(func, args))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+
+    while pending:
+        yield pending.popleft().get()
+
+def _get_build_actions(index, builder_name, build_pickle_path, timezone,
+                       slim_steps):
+    ''' Returns (builder name, build pickle path, documents of the build),
+        documents being None if the build couldn't be read '''
+    try:
+        actions = _create_build_actions(index, builder_name, build_pickle_path,
+                                        timezone, slim_steps)
+    #pylint: disable=broad-except
+    except Exception:
+        _LOGGER.exception('Error creating documents of build %s:%s. This '
+                          'build will be ignored.', builder_name,
+                          build_pickle_path)
+        actions = None
+    return builder_name, build_pickle_path, actions
+
+def _create_build_actions(index, builder_name, build_pickle_path, timezone,
+                          slim_steps):
+    build = _load_build(builder_name, build_pickle_path)
+    if build is None:
+        return []
+
+    actions = []
+    build_id = '_'.join([builder_name, str(build.number)])
+    build_properties = _get_build_properties(build, timezone)
+    _LOGGER.debug('Created build %s:%s document',
+                  builder_name,
+                  build.number)
+    for key, value in build_properties.iteritems():
+        _LOGGER.debug('%s : %s', key, value)
+
+    for step in build.steps:
+        if step.started is None:
+            continue
+
+        step_id = '_'.join([build_id, str(step.step_number)])
+        step_properties = _get_step_properties(build, step, timezone,
+                                               slim_steps)
+        _LOGGER.debug('Created step %s:%s:%s document',
+                      builder_name,
+                      build.number,
+                      step.step_number)
+        for key, value in step_properties.iteritems():
+            _LOGGER.debug('%s : %s', key, value)
+        actions.append(_get_action(index, 'step', step_id, step_properties))
+
+    actions.append(_get_action(index, 'build', build_id, build_properties))
+
+    _LOGGER.debug('Loaded build %s:%s', builder_name, build.number)
+    return actions
+
+def _create_sink(args, database):
+    sink_class = _SINKS[args.sink]
+    if sink_class is _ElasticsearchSink:
+        return _ElasticsearchSink(database,
+                                  args.threads,
+                                  args.max_chunk_bytes,
+                                  args.max_retries,
+                                  args.dead_letter)
+
+    if sink_class is _ColumnarSink:
+        _remove_parts(args.output, args.overwrite)
+    else:
+        _remove_state(args.output, args.overwrite)
+    return sink_class(args.output)
+
+def _to_json_value(value):
+    if isinstance(value, basestring):
+        return value
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return str(value)
+
+class _Sink(object):
+    ''' Writes documents somewhere '''
+    def write(self, actions):
+        ''' Writes given actions, yielding a (success, document id, details)
+            tuple for each of them, in order '''
+        raise NotImplementedError()
+
+    def flush(self):
+        ''' Makes sure written documents are stored '''
+        pass
+
+    def close(self):
+        ''' Releases this sink resources '''
+        pass
+
+class _ElasticsearchSink(_Sink):
+    ''' Indexes documents in Elasticsearch, with bulk requests bounded in
+        document count and size, retried on overload and connection errors '''
+    def __init__(self, database, threads, max_chunk_bytes, max_retries,
+                 dead_letter_path):
+        self._database = database
+        self._threads = threads
+        self._max_chunk_bytes = max_chunk_bytes
+        self._max_retries = max_retries
+        self._dead_letter_path = dead_letter_path
+        self._dead_letter_file = None
+        self._lock = threading.Lock()
+        self._stats = {'chunks' : 0, 'documents' : 0, 'bytes' : 0,
+                       'retries' : 0, 'rejected' : 0, 'duration' : 0.0}
+
+    def write(self, actions):
+        pool = multiprocessing.pool.ThreadPool(self._threads)
+        try:
+            chunks = ((chunk,) for chunk in self._get_chunks(actions))
+            for results in _imap_bounded(pool, self._send_chunk, chunks,
+                                         self._threads * 2):
+                for result in results:
+                    yield result
+        finally:
+            pool.terminate()
+
+    def close(self):
+        stats = self._stats
+        if stats['chunks'] > 0:
+            _LOGGER.info('Sent %s documents (%s bytes) in %s bulk requests, '
+                         '%.3fs average latency, %s retries, %s rejected',
+                         stats['documents'], stats['bytes'], stats['chunks'],
+                         stats['duration'] / stats['chunks'],
+                         stats['retries'], stats['rejected'])
+        if self._dead_letter_file is not None:
+            self._dead_letter_file.close()
+
+    def _get_chunks(self, actions):
+        serializer = self._database.transport.serializer
+        chunk, chunk_bytes = [], 0
+        for action in actions:
+            meta, data = elasticsearch.helpers.expand_action(action)
+            # Documents of all types share the index mapping, their type
+            # is stored in their 'type' field
+            meta.values()[0]['_type'] = _MAPPING_TYPE
+            lines = [serializer.dumps(meta), serializer.dumps(data)]
+            size = sum(len(it) + 1 for it in lines)
+            if chunk and (len(chunk) >= _CHUNK_SIZE or
+                          chunk_bytes + size > self._max_chunk_bytes):
+                yield chunk
+                chunk, chunk_bytes = [], 0
+            chunk.append((action, lines))
+            chunk_bytes += size
+
+        if chunk:
+            yield chunk
+
+    def _send_chunk(self, chunk):
+        start = time.time()
+        chunk_bytes = sum(len(it) + 1 for _, lines in chunk for it in lines)
+        results = [None] * len(chunk)
+        pending = list(enumerate(chunk))
+        retry = 0
+        while pending:
+            if retry > 0:
+                time.sleep(min(_MAX_BACKOFF, _INITIAL_BACKOFF * 2 ** (retry - 1)))
+
+            body = ''.join(it + '\n' for _, (_, lines) in pending
+                           for it in lines)
+            can_retry = retry < self._max_retries
+            try:
+                response = self._database.bulk(body=body)
+            except elasticsearch.TransportError as ex:
+                if can_retry and (ex.status_code == 429 or
+                                  isinstance(ex, elasticsearch.ConnectionError)):
+                    _LOGGER.warn('Bulk request failed, retrying : %s', ex)
+                    retry += 1
+                    continue
+                for position, (action, _) in pending:
+                    results[position] = (False, action['_id'], str(ex))
+                    self._write_dead_letter(action, str(ex))
+                break
+
+            rejected = []
+            for (position, (action, lines)), item in zip(pending,
+                                                         response['items']):
+                details = item.values()[0]
+                status = details.get('status', 500)
+                if 200 <= status < 300:
+                    results[position] = (True, action['_id'], item)
+                elif status == 429 and can_retry:
+                    rejected.append((position, (action, lines)))
+                else:
+                    results[position] = (False, action['_id'], item)
+                    self._write_dead_letter(action, details.get('error'))
+
+            pending = rejected
+            if pending:
+                _LOGGER.warn('%s documents rejected by an overloaded cluster, '
+                             'retrying', len(pending))
+                retry += 1
+
+        duration = time.time() - start
+        _LOGGER.debug('Sent %s documents (%s bytes) in %.3fs, %.0f documents/s',
+                      len(chunk), chunk_bytes, duration,
+                      len(chunk) / max(duration, 0.001))
+        with self._lock:
+            stats = self._stats
+            stats['chunks'] += 1
+            stats['documents'] += len(chunk)
+            stats['bytes'] += chunk_bytes
+            stats['retries'] += retry
+            stats['duration'] += duration
+
+        return results
+
+    def _write_dead_letter(self, action, error):
+        line = json.dumps({'_index' : action['_index'],
+                           '_type' : action['_type'],
+                           '_id' : action['_id'],
+                           'error' : error,
+                           'document' : action['_source']},
+                          default=_to_json_value,
+                          sort_keys=True)
+        with self._lock:
+            self._stats['rejected'] += 1
+            if self._dead_letter_file is None:
+                self._dead_letter_file = open(self._dead_letter_path, 'ab')
+            self._dead_letter_file.write(line + '\n')
+            self._dead_letter_file.flush()
+
+class _NdjsonSink(_Sink):
+    ''' Writes a document per line, in a gzipped file if its name ends with
+        .gz '''
+    def __init__(self, path):
+        if path.endswith('.gz'):
+            self._file = gzip.open(path, 'ab')
+        else:
+            self._file = open(path, 'ab')
+
+    def write(self, actions):
+        for action in actions:
+            document = dict(action['_source'])
+            document['_id'] = action['_id']
+            document['_type'] = action['_type']
+            line = json.dumps(document, default=_to_json_value, sort_keys=True)
+            self._file.write(line + '\n')
+            yield True, action['_id'], None
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+class _SqliteSink(_Sink):
+    ''' Stores documents in a SQLite database, with the fields used by most
+        queries in columns and the whole document as JSON '''
+    _COLUMNS = ['buildername', 'buildnumber', 'step_name', 'step_number',
+                'start', 'end', 'duration', 'result']
+
+    def __init__(self, path):
+        self._connection = sqlite3.connect(path)
+        columns = ', '.join('"%s"' % it for it in self._COLUMNS)
+        with self._connection:
+            self._connection.execute('CREATE TABLE IF NOT EXISTS documents ('
+                                     'id TEXT PRIMARY KEY, type TEXT, %s, '
+                                     'document TEXT)' % columns)
+        placeholders = ', '.join(['?'] * (len(self._COLUMNS) + 3))
+        self._insert = ('INSERT OR REPLACE INTO documents (id, type, %s, '
+                        'document) VALUES (%s)' % (columns, placeholders))
+
+    def write(self, actions):
+        for chunk in _get_chunks(actions, _CHUNK_SIZE):
+            rows = []
+            for action in chunk:
+                document = action['_source']
+                row = [action['_id'], action['_type']]
+                for column in self._COLUMNS:
+                    value = document.get(column)
+                    if isinstance(value, datetime.datetime):
+                        value = value.isoformat()
+                    row.append(value)
+                row.append(json.dumps(document, default=_to_json_value))
+                rows.append(row)
+
+            # One transaction per chunk
+            with self._connection:
+                self._connection.executemany(self._insert, rows)
+
+            for action in chunk:
+                yield True, action['_id'], None
+
+    def close(self):
+        self._connection.close()
+
+class _ColumnarSink(_Sink):
+    ''' Writes documents to Parquet files in the output directory, one file
+        per chunk as properties, thus columns, differ between builds '''
+    def __init__(self, path):
+        if pyarrow is None:
+            raise ImportError('The columnar sink needs pyarrow')
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._path = path
+        self._part = len(os.listdir(path))
+
+    def write(self, actions):
+        for chunk in _get_chunks(actions, _CHUNK_SIZE):
+            columns = {'_id' : [], '_type' : []}
+            for row, action in enumerate(chunk):
+                document = dict(action['_source'])
+                document['_id'] = action['_id']
+                document['_type'] = action['_type']
+                for key, value in document.iteritems():
+                    if key not in columns:
+                        columns[key] = [None] * row
+                    columns[key].append(value)
+                for values in columns.itervalues():
+                    if len(values) == row:
+                        values.append(None)
+
+            names = sorted(columns)
+            arrays = [self._get_array(columns[it]) for it in names]
+            table = pyarrow.Table.from_arrays(arrays, names)
+            part_path = os.path.join(self._path,
+                                     'part-%05d.parquet' % self._part)
+            pyarrow.parquet.write_table(table, part_path)
+            self._part += 1
+
+            for action in chunk:
+                yield True, action['_id'], None
+
+    @staticmethod
+    def _get_array(values):
+        try:
+            return pyarrow.array(values)
+        # Properties with values of different types are stored as strings
+        #pylint: disable=broad-except
+        except Exception:
+            return pyarrow.array([None if it is None else _to_json_value(it)
+                                  for it in values])
+
+_SINKS = {
+    'elasticsearch' : _ElasticsearchSink,
+    'ndjson' : _NdjsonSink,
+    'sqlite' : _SqliteSink,
+    'columnar' : _ColumnarSink,
+}
+
+def _get_chunks(iterable, chunk_size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+def _create_analyses(args):
+    analyses = []
+    if args.rollups is not None:
+        _remove_state(args.rollups, args.overwrite)
+        rollup_index = args.rollup_index or args.index + '_rollups'
+        analyses.append(_Rollups(args.rollups, rollup_index))
+
+    if args.chains is not None:
+        _remove_state(args.chains, args.overwrite)
+        analyses.append(_TriggerChains(args.chains, args.index))
+
+    return analyses
+
+def _remove_state(path, overwrite):
+    if overwrite and os.path.exists(path):
+        os.remove(path)
+
+def _remove_parts(path, overwrite):
+    ''' Removes Parquet files written by the columnar sink, leaving anything
+        else in its output directory '''
+    if overwrite and os.path.isdir(path):
+        for file_name in os.listdir(path):
+            if file_name.startswith('part-') and file_name.endswith('.parquet'):
+                os.remove(os.path.join(path, file_name))
+
+class _Rollups(object):
+    ''' Daily duration statistics per builder and per builder step, updated
+        as builds are indexed. Their state is kept in a SQLite database, and
+        they are written as documents to the rollup index '''
+    _FIELDS = ['duration', 'waiting_duration', 'total_duration']
+    _QUANTILES = [50, 90, 95, 99]
+
+    def __init__(self, path, index):
+        self._index = index
+        self._connection = sqlite3.connect(path)
+        with self._connection:
+            self._connection.execute('CREATE TABLE IF NOT EXISTS rollups ('
+                                     'id TEXT PRIMARY KEY, rollup TEXT)')
+            self._connection.execute('CREATE TABLE IF NOT EXISTS '
+                                     'counted_builds (buildername TEXT, '
+                                     'buildnumber INTEGER, '
+                                     'PRIMARY KEY (buildername, buildnumber))')
+        # Builds can be indexed out of order, counted ones are recorded one by
+        # one. Added builds are counted on flush, once the counted ones among
+        # them are looked up, as all of them can't be loaded
+        self._new_builds = collections.OrderedDict()
+        self._pending_steps = {}
+        self._rollups = {}
+
+    def add(self, doc_type, document):
+        ''' Adds an indexed document to rollups. Steps are only counted with
+            their build document, so that a build is counted once even if
+            indexing is interrupted between its documents, or indexed
+            again '''
+        key = (document.get('buildername'), document.get('buildnumber'))
+        if doc_type == 'step':
+            self._pending_steps.setdefault(key, []).append(document)
+            return
+
+        if doc_type != 'build':
+            return
+
+        steps = self._pending_steps.pop(key, [])
+        self._new_builds[key] = (steps, document)
+
+    def flush(self, sink):
+        ''' Counts added builds, writes updated rollups to the sink and saves
+            their state '''
+        counted_builds = self._get_counted_builds(self._new_builds)
+        new_builds = [it for it in self._new_builds if it not in counted_builds]
+        for key in new_builds:
+            steps, document = self._new_builds[key]
+            for step in steps:
+                self._add_document(key[0], step.get('step_name'), step)
+            self._add_document(key[0], None, document)
+        self._new_builds.clear()
+        if not self._rollups:
+            return
+
+        actions = [_get_action(self._index, 'rollup', rollup_id,
+                               self._get_document(rollup))
+                   for rollup_id, rollup in sorted(self._rollups.iteritems())]
+        for success, doc_id, result in sink.write(actions):
+            if not success:
+                _LOGGER.error('Error indexing rollup %s : %s', doc_id, result)
+
+        rows = [(rollup_id, json.dumps(rollup, default=_QuantileSketch.to_dict))
+                for rollup_id, rollup in self._rollups.iteritems()]
+        with self._connection:
+            self._connection.executemany('INSERT OR REPLACE INTO rollups '
+                                         '(id, rollup) VALUES (?, ?)', rows)
+            self._connection.executemany('INSERT OR REPLACE INTO '
+                                         'counted_builds (buildername, '
+                                         'buildnumber) VALUES (?, ?)',
+                                         new_builds)
+        self._rollups = {}
+
+    def close(self):
+        ''' Closes the state database '''
+        self._connection.close()
+
+    def _get_counted_builds(self, keys):
+        builds = collections.defaultdict(list)
+        for builder_name, build_number in keys:
+            builds[builder_name].append(build_number)
+
+        counted_builds = set()
+        for builder_name, build_numbers in builds.iteritems():
+            # Below the SQLite limit of 999 parameters
+            for chunk in _get_chunks(build_numbers, 500):
+                query = ('SELECT buildnumber FROM counted_builds '
+                         'WHERE buildername = ? AND buildnumber IN (%s)' %
+                         ', '.join('?' * len(chunk)))
+                rows = self._connection.execute(query, [builder_name] + chunk)
+                counted_builds.update((builder_name, it) for it, in rows)
+        return counted_builds
+
+    def _add_document(self, builder_name, step_name, document):
+        day = document['start'].date().isoformat()
+        if step_name is None:
+            rollup_id = '_'.join([builder_name, day, 'build'])
+        else:
+            rollup_id = '_'.join([builder_name, day, 'step', step_name])
+
+        rollup = self._get_rollup(rollup_id)
+        if rollup is None:
+            rollup = {'buildername' : builder_name,
+                      'step_name' : step_name,
+                      'day' : day,
+                      'stats' : {}}
+            self._rollups[rollup_id] = rollup
+
+        for field in self._FIELDS:
+            value = document.get(field)
+            if value is None:
+                continue
+            if field not in rollup['stats']:
+                rollup['stats'][field] = {'count' : 0,
+                                          'sum' : 0.0,
+                                          'min' : value,
+                                          'max' : value,
+                                          'sketch' : _QuantileSketch()}
+            stats = rollup['stats'][field]
+            stats['count'] += 1
+            stats['sum'] += value
+            stats['min'] = min(stats['min'], value)
+            stats['max'] = max(stats['max'], value)
+            stats['sketch'].add(value)
+
+    def _get_rollup(self, rollup_id):
+        if rollup_id not in self._rollups:
+            query = 'SELECT rollup FROM rollups WHERE id = ?'
+            row = self._connection.execute(query, (rollup_id,)).fetchone()
+            if row is None:
+                return None
+            rollup = json.loads(row[0])
+            for stats in rollup['stats'].itervalues():
+                stats['sketch'] = _QuantileSketch.from_dict(stats['sketch'])
+            self._rollups[rollup_id] = rollup
+        return self._rollups[rollup_id]
+
+    def _get_document(self, rollup):
+        document = {
+            'type' : 'rollup',
+            'rollup_type' : 'build' if rollup['step_name'] is None else 'step',
+            'buildername' : rollup['buildername'],
+            'day' : rollup['day'],
+        }
+        if rollup['step_name'] is not None:
+            document['step_name'] = rollup['step_name']
+
+        for field, stats in rollup['stats'].iteritems():
+            for key in ['count', 'sum', 'min', 'max']:
+                document['%s_%s' % (field, key)] = stats[key]
+            sketch = stats['sketch']
+            document['%s_sketch' % field] = sketch.to_dict()
+            for quantile in self._QUANTILES:
+                # Bin centers can be past the observed values
+                value = sketch.get_quantile(quantile / 100.0)
+                value = min(max(value, stats['min']), stats['max'])
+                document['%s_p%s' % (field, quantile)] = value
+
+        return document
+
+class _TriggerChains(object):
+    ''' Links builds started by ebb Trigger steps to their parent build, and
+        writes a document per chain of triggered builds with its critical
+        path, queue time and parallelism '''
+    def __init__(self, path, index):
+        self._index = index
+        self._connection = sqlite3.connect(path)
+        with self._connection:
+            self._connection.execute('CREATE TABLE IF NOT EXISTS builds ('
+                                     'id TEXT PRIMARY KEY, '
+                                     'buildername TEXT, '
+                                     'buildnumber INTEGER, '
+                                     'started REAL, '
+                                     'finished REAL, '
+                                     'parent_id TEXT, '
+                                     'parent_stepname TEXT, '
+                                     'step_starts TEXT)')
+            self._connection.execute('CREATE INDEX IF NOT EXISTS builds_parent '
+                                     'ON builds (parent_id)')
+        self._step_starts = {}
+        self._builds = []
+
+    def add(self, doc_type, document):
+        ''' Records start times of a build and its steps '''
+        if doc_type not in ['build', 'step']:
+            return
+
+        build_id = '_'.join([document.get('buildername'),
+                             str(document.get('buildnumber'))])
+        if doc_type == 'step':
+            step_starts = self._step_starts.setdefault(build_id, {})
+            start = _to_timestamp(document['start'])
+            step_starts[document.get('step_name')] = start
+            return
+
+        parent_id = None
+        if document.get('parent_buildername') is not None:
+            parent_id = '_'.join([document['parent_buildername'],
+                                  str(document.get('parent_buildnumber'))])
+
+        self._builds.append((build_id,
+                             document.get('buildername'),
+                             document.get('buildnumber'),
+                             _to_timestamp(document['start']),
+                             _to_timestamp(document['end']),
+                             parent_id,
+                             document.get('parent_stepname'),
+                             json.dumps(self._step_starts.pop(build_id, {}))))
+
+    def flush(self, sink):
+        ''' Saves recorded builds, and writes documents of chains they belong
+            to '''
+        if not self._builds:
+            return
+
+        with self._connection:
+            self._connection.executemany('INSERT OR REPLACE INTO builds '
+                                         'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                         self._builds)
+
+        # Parents usually wait for triggered builds, and finish after them :
+        # chains are computed again each time one of their builds is added
+        root_ids = set()
+        for build in self._builds:
+            root_id = self._get_root_id(build[0])
+            if root_id is not None:
+                root_ids.add(root_id)
+        self._builds = []
+
+        actions = []
+        for root_id in sorted(root_ids):
+            document = self._get_chain_document(root_id)
+            if document is not None:
+                actions.append(_get_action(self._index, 'chain',
+                                           'chain_' + root_id, document))
+
+        for success, doc_id, result in sink.write(actions):
+            if not success:
+                _LOGGER.error('Error indexing chain %s : %s', doc_id, result)
+
+    def close(self):
+        ''' Closes the state database '''
+        self._connection.close()
+
+    def _get_build(self, build_id):
+        query = ('SELECT id, buildername, buildnumber, started, finished, '
+                 'parent_id, parent_stepname, step_starts FROM builds '
+                 'WHERE id = ?')
+        return self._connection.execute(query, (build_id,)).fetchone()
+
+    def _get_root_id(self, build_id):
+        ''' Returns the first build of a chain, or None if it wasn't indexed
+            yet '''
+        visited = set()
+        while build_id not in visited:
+            visited.add(build_id)
+            build = self._get_build(build_id)
+            if build is None:
+                return None
+            if build[5] is None:
+                return build_id
+            build_id = build[5]
+        return None
+
+    def _get_chain_document(self, root_id):
+        builds = {root_id : self._get_build(root_id)}
+        children = {}
+        queue_times = {root_id : 0.0}
+        pending = [root_id]
+        query = ('SELECT id, buildername, buildnumber, started, finished, '
+                 'parent_id, parent_stepname, step_starts FROM builds '
+                 'WHERE parent_id = ?')
+        while pending:
+            parent = builds[pending.pop()]
+            step_starts = json.loads(parent[7])
+            for child in self._connection.execute(query, (parent[0],)):
+                if child[0] in builds:
+                    continue
+                builds[child[0]] = child
+                children.setdefault(parent[0], []).append(child[0])
+                trigger_time = step_starts.get(child[6], parent[3])
+                queue_times[child[0]] = max(0.0, child[3] - trigger_time)
+                pending.append(child[0])
+
+        # Single builds aren't chains
+        if len(builds) < 2:
+            return None
+
+        # Follow the triggered build finishing last, down to the one that
+        # determined when the chain finished
+        critical_path = [root_id]
+        while critical_path[-1] in children:
+            last_child = max(children[critical_path[-1]],
+                             key=lambda it: builds[it][4])
+            critical_path.append(last_child)
+
+        start = builds[root_id][3]
+        end = max(it[4] for it in builds.itervalues())
+        wall_duration = end - start
+        run_time = sum(it[4] - it[3] for it in builds.itervalues())
+        parallelism = run_time / wall_duration if wall_duration > 0 else 1.0
+        root = builds[root_id]
+        return {
+            'type' : 'chain',
+            'buildername' : root[1],
+            'buildnumber' : root[2],
+            'start' : _from_timestamp(start),
+            'end' : _from_timestamp(end),
+            'builds_count' : len(builds),
+            'wall_duration' : wall_duration,
+            'total_run_time' : run_time,
+            'total_queue_time' : sum(queue_times.itervalues()),
+            'critical_path' : [' #'.join([builds[it][1], str(builds[it][2])])
+                               for it in critical_path],
+            'critical_path_queue_time' : sum(queue_times[it]
+                                             for it in critical_path),
+            'critical_path_run_time' : sum(builds[it][4] - builds[it][3]
+                                           for it in critical_path[1:]),
+            'parallelism' : parallelism,
+            'parallelism_efficiency' : parallelism / len(builds),
+        }
+
+def _to_timestamp(date):
+    return (date - _EPOCH).total_seconds()
+
+def _from_timestamp(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp, tz=_UTC)
+
+class _QuantileSketch(object):
+    ''' Quantile sketch with a bounded relative error, as described in the
+        DDSketch paper : values are counted in logarithmic bins. Sketches are
+        merged by adding counts of identical bins '''
+    _RELATIVE_ACCURACY = 0.01
+    _GAMMA = (1 + _RELATIVE_ACCURACY) / (1 - _RELATIVE_ACCURACY)
+    _LOG_GAMMA = math.log(_GAMMA)
+
+    def __init__(self):
+        self._bins = collections.Counter()
+        self._zeros = 0
+
+    def add(self, value):
+        ''' Counts a value, negative ones being counted as zero '''
+        if value <= 0:
+            self._zeros += 1
+        else:
+            self._bins[int(math.ceil(math.log(value) / self._LOG_GAMMA))] += 1
+
+    def get_quantile(self, quantile):
+        ''' Returns an approximation of given quantile, between 0 and 1 '''
+        count = self._zeros + sum(self._bins.itervalues())
+        if count == 0:
+            return None
+
+        rank = quantile * (count - 1)
+        cumulated_count = self._zeros
+        if rank < cumulated_count:
+            return 0.0
+
+        for key in sorted(self._bins):
+            cumulated_count += self._bins[key]
+            if rank < cumulated_count:
+                break
+        return 2 * self._GAMMA ** key / (self._GAMMA + 1)
+
+    def to_dict(self):
+        ''' Returns a JSON serializable representation of this sketch '''
+        keys = sorted(self._bins)
+        return {'keys' : keys,
+                'counts' : [self._bins[it] for it in keys],
+                'zeros' : self._zeros}
+
+    @staticmethod
+    def from_dict(content):
+        ''' Creates a sketch from the output of to_dict '''
+        sketch = _QuantileSketch()
+        sketch._bins.update(dict(zip(content['keys'], content['counts'])))
+        sketch._zeros = content['zeros']
+        return sketch
+
+def _track_documents(actions, sent_documents):
+    for action in actions:
+        sent_documents.append(action)
+        yield action
+
+class _Checkpoint(object):
+    ''' Indexing progress of each builder : the highest indexed build number,
+        and the builds below it that are not indexed yet. Builds that are
+        unfinished or fail to index are kept pending, and indexed on a later
+        pass instead of being skipped by the following ones '''
+    def __init__(self, last_builds=None):
+        # Builder name -> [last indexed build, set of pending builds]. Listed
+        # builds are pending until indexed, those above the last indexed one
+        # are listed again on next run, and aren't saved
+        self._builders = {}
+        for builder_name, last_build in (last_builds or {}).iteritems():
+            self._builders[builder_name] = [last_build, set()]
+
+    @staticmethod
+    def load(path):
+        ''' Loads a checkpoint saved by save '''
+        checkpoint = _Checkpoint()
+        for builder_name, progress in _load_json(path).iteritems():
+            checkpoint._builders[builder_name] = [progress['last'],
+                                                  set(progress['pending'])]
+            _LOGGER.debug('Builder %s last indexed build is %s, %s builds '
+                          'are pending', builder_name, progress['last'],
+                          len(progress['pending']))
+
+        return checkpoint
+
+    def save(self, path):
+        ''' Saves the checkpoint as JSON '''
+        content = {}
+        for builder_name, (last_build, pending) in self._builders.iteritems():
+            pending = sorted(build_number for build_number in pending
+                             if build_number < last_build)
+            content[builder_name] = {'last' : last_build, 'pending' : pending}
+        _save_json(path, content)
+
+    def should_index(self, builder_name, build_number):
+        ''' Returns True if the build wasn't indexed yet '''
+        last_build, pending = self._builders.get(builder_name, (-1, ()))
+        return build_number > last_build or build_number in pending
+
+    def list_builds(self, builder_name, build_numbers):
+        ''' Returns the given sorted build numbers of a builder that weren't
+            indexed yet, and marks them as pending. Pending builds missing
+            from build_numbers were deleted, and are forgotten '''
+        last_build, pending = self._builders.setdefault(builder_name,
+                                                        [-1, set()])
+        pending.intersection_update(build_numbers)
+        first_build = bisect.bisect_right(build_numbers, last_build)
+        result = sorted(build_number for build_number in pending
+                        if build_number <= last_build)
+        result.extend(build_numbers[first_build:])
+        pending.update(result)
+        return result
+
+    def set_listed(self, builder_name, build_number):
+        ''' Marks a build as pending, until set_done is called for it '''
+        progress = self._builders.setdefault(builder_name, [-1, set()])
+        progress[1].add(build_number)
+
+    def set_done(self, builder_name, build_number):
+        ''' Marks a build as indexed, or as ignored when it can't be read '''
+        progress = self._builders.setdefault(builder_name, [-1, set()])
+        progress[0] = max(progress[0], build_number)
+        progress[1].discard(build_number)
+
+def _load_json(path):
+    with open(path, 'r') as json_file:
+        return json.load(json_file)
+
+def _save_json(path, content):
+    # Write then rename, so that an interrupted run never leaves a truncated
+    # file behind
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as json_file:
+        json.dump(content, json_file, indent=4, sort_keys=True)
+        json_file.flush()
+        os.fsync(json_file.fileno())
+    os.rename(temp_path, path)
+
+def _setup_indices(database, args):
+    ''' Installs index templates, and deletes monthly indices older than the
+        retention period '''
+    index = args.index
+    if (database.indices.exists(index=index) and
+            not database.indices.exists_alias(name=index)):
+        raise ValueError('%s is an index, it must be reindexed into monthly '
+                         'indices or deleted before it can be used as an '
+                         'alias' % index)
+
+    _LOGGER.info('Installing index template %s', index)
+    database.indices.put_template(name=index, body={
+        'index_patterns' : [index + '-*'],
+        'settings' : _INDEX_SETTINGS,
+        'aliases' : {index : {}},
+        'mappings' : {_MAPPING_TYPE : _MAPPING}
+    })
+
+    if args.rollups is not None:
+        rollup_index = args.rollup_index or index + '_rollups'
+        _LOGGER.info('Installing index template %s', rollup_index)
+        database.indices.put_template(name=rollup_index, body={
+            'index_patterns' : [rollup_index],
+            'order' : 1,
+            'settings' : _INDEX_SETTINGS,
+            'mappings' : {_MAPPING_TYPE : _MAPPING}
+        })
+
+    if args.retention_months is not None:
+        _delete_old_indices(database, index, args.retention_months)
+
+def _delete_old_indices(database, index, retention_months):
+    now = datetime.datetime.utcnow()
+    months = now.year * 12 + now.month - 1 - retention_months
+    oldest_month = datetime.datetime(months // 12, months % 12 + 1, 1)
+
+    pattern = index + '-*'
+    for index_name in sorted(database.indices.get(index=pattern)):
+        try:
+            month = datetime.datetime.strptime(index_name[len(index) + 1:],
+                                               _INDEX_MONTH_FORMAT)
+        except ValueError:
+            continue
+        if month < oldest_month:
+            _LOGGER.info('Deleting index %s, older than %s months',
+                         index_name, retention_months)
+            database.indices.delete(index=index_name)
+
+def _get_index_name(index, date):
+    date = date.astimezone(_UTC)
+    return '%s-%s' % (index, date.strftime(_INDEX_MONTH_FORMAT))
 
 def _get_last_builds(database, index):
+    _LOGGER.info('Rebuilding checkpoint from index %s', index)
+    composite = {
+        'size' : _CHECKPOINT_PAGE_SIZE,
+        'sources' : [{'buildername' : {'terms' : {'field' : 'buildername'}}}]
+    }
     body = {
-        "query": {
-            'match_all' : {}
+        'size' : 0,
+        'query' : {
+            'term' : {'type' : 'build'}
         },
-        "aggs" : {
-            "builders": {
-                "terms": {"field": "buildername", 'size':0},
-                "aggs": {
-                    "last_build": {
-                        "max": {"field": "buildnumber"}
+        'aggs' : {
+            'builders' : {
+                'composite' : composite,
+                'aggs' : {
+                    'last_build' : {
+                        'max' : {'field' : 'buildnumber'}
                     }
                 }
             }
         }
     }
 
-    page = database.search(index=index, doc_type='build', body=body)
     last_builds = {}
-    for bucket in page['aggregations']['builders']['buckets']:
-        builder_name = bucket['key']
-        last_build = bucket['last_build']['value']
-        if last_build is None:
-            last_build = -1
-        last_builds[builder_name] = int(last_build)
+    while True:
+        try:
+            page = database.search(index=index, body=body)
+        except elasticsearch.NotFoundError:
+            # Monthly indices, and the alias with them, are created with the
+            # first indexed document
+            _LOGGER.info('Index %s does not exist yet, starting from scratch',
+                         index)
+            return last_builds
+        builders = page['aggregations']['builders']
+        for bucket in builders['buckets']:
+            builder_name = bucket['key']['buildername']
+            last_build = bucket['last_build']['value']
+            if last_build is None:
+                last_build = -1
+            last_builds[builder_name] = int(last_build)
+
+        if not builders['buckets'] or 'after_key' not in builders:
+            break
+        composite['after'] = builders['after_key']
 
     for builder_name, last_build in last_builds.iteritems():
-        logging.debug('Builder %s last indexed build is %s',
+        _LOGGER.debug('Builder %s last indexed build is %s',
                       builder_name,
                       last_build)
 
     return last_builds
 
-def _discover_builders(root_directory):
+def _discover_builders(root_directory, pool, max_pending, builder_cache_path,
+                       errors):
+    builder_cache = {}
+    if builder_cache_path is not None and os.path.exists(builder_cache_path):
+        builder_cache = _load_json(builder_cache_path)
+
+    builders = []
+    builder_pickle_paths = []
     for root, _, files in os.walk(root_directory):
-        for file_name in files:
-            if file_name == 'builder':
-                builder_pickle_path = os.path.join(root, file_name)
-                try:
-                    with open(builder_pickle_path, 'r') as builder_pickle:
-                        builder = cPickle.load(builder_pickle)
-                #pylint: disable=broad-except
-                except cPickle.UnpicklingError as ex:
-                    _LOGGER.warn('Error unpickling builder file %s : %s.'
-                                 ' this builder will be ignored.',
-                                 builder_pickle_path, ex)
-                    continue
+        if 'builder' not in files:
+            continue
 
-                builder_dir = os.path.dirname(builder_pickle_path)
-                builder_dir = os.path.abspath(builder_dir)
-                builder_dir = os.path.normpath(builder_dir)
-                _LOGGER.debug('Found new builder directory %s.', builder_dir)
+        builder_dir = os.path.normpath(os.path.abspath(root))
+        builder_pickle_path = os.path.join(builder_dir, 'builder')
+        builder_stat = os.stat(builder_pickle_path)
+        builder_key = [builder_stat.st_mtime, builder_stat.st_size]
+        cache_entry = builder_cache.get(builder_dir)
+        if cache_entry is not None and cache_entry[1:] == builder_key:
+            builders.append((cache_entry[0], builder_dir))
+            continue
 
-                yield builder.name, builder_dir
+        # Only unpickle builders that changed since the last run
+        builder_cache.pop(builder_dir, None)
+        builders.append((None, builder_dir))
+        builder_pickle_paths.append((builder_pickle_path,))
+        builder_cache[builder_dir] = [None] + builder_key
 
-def _load_builds(builder_name, builder_dir, last_indexed_build):
-    for root, _, files in os.walk(builder_dir):
-        for file_name in files:
-            if re.match(r'^\d+$', file_name):
-                build_number = int(file_name)
-                build_pickle_path = os.path.join(root, file_name)
+    builder_names = _imap_bounded(pool, _load_builder_name,
+                                  builder_pickle_paths, max_pending)
+    builder_names = iter(list(builder_names))
+    for builder_name, builder_dir in builders:
+        if builder_name is None:
+            builder_name = next(builder_names)
+            if builder_name is None:
+                del builder_cache[builder_dir]
+                errors['builders'] += 1
+                continue
+            builder_cache[builder_dir][0] = builder_name
 
-                if build_number <= last_indexed_build:
-                    _LOGGER.debug('Ignoring already indexed build  %s',
-                                  build_pickle_path)
-                    continue
+        _LOGGER.debug('Found new builder directory %s.', builder_dir)
+        yield builder_name, builder_dir
 
-                try:
-                    with open(build_pickle_path, 'r') as file_content:
-                        build = cPickle.load(file_content)
-                #pylint: disable=broad-except
-                except cPickle.UnpicklingError as ex:
-                    _LOGGER.warn(('Error while loading build pickle %s : '
-                                  '%s. This build will be discarded.'),
-                                 build_pickle_path, ex)
-                    continue
+    if builder_cache_path is not None and builder_pickle_paths:
+        _save_json(builder_cache_path, builder_cache)
 
-                _LOGGER.debug('Loaded %s build pickle', build_pickle_path)
+def _load_builder_name(builder_pickle_path):
+    try:
+        builder = _load_pickle(builder_pickle_path)
+    #pylint: disable=broad-except
+    except Exception as ex:
+        _LOGGER.warn('Error unpickling builder file %s : %s.'
+                     ' this builder will be ignored.',
+                     builder_pickle_path, ex)
+        return None
 
-                if build.results is None:
-                    _LOGGER.info(('Build %s:%s is not finished yet, '
-                                  'ignoring it for now'),
-                                 builder_name, build.number)
-                    continue
+    return builder.name
+
+def _get_build_paths(builder_name, builder_dir, checkpoint):
+    builds = dict(_list_builds(builder_dir))
+    build_numbers = checkpoint.list_builds(builder_name, sorted(builds))
+    if len(build_numbers) < len(builds):
+        _LOGGER.debug('Ignoring %s already indexed builds in %s',
+                      len(builds) - len(build_numbers),
+                      builder_dir)
+
+    for build_number in build_numbers:
+        yield os.path.join(builder_dir, builds[build_number])
+
+def _list_builds(builder_dir):
+    ''' Yields (build number, file name) of build pickles in a builder
+        directory, skipping logs without matching them against a regex '''
+    if _scandir is None:
+        for file_name in os.listdir(builder_dir):
+            if file_name.isdigit():
+                yield int(file_name), file_name
+        return
+
+    for entry in _scandir(builder_dir):
+        if entry.name.isdigit() and entry.is_file():
+            yield int(entry.name), entry.name
+
+def _load_build(builder_name, build_pickle_path):
+    # Unpickling errors are reported by _get_build_actions
+    build = _load_pickle(build_pickle_path)
+    _LOGGER.debug('Loaded %s build pickle', build_pickle_path)
+
+    if build.results is None:
+        _LOGGER.info(('Build %s:%s is not finished yet, '
+                      'ignoring it for now'),
+                     builder_name, build.number)
+        return None
+
+    return build
+
+def _load_pickle(pickle_path):
+    ''' Loads a buildbot status pickle, mapping buildbot classes to the slim
+        records below, and ignoring everything else '''
+    with open(pickle_path, 'rb') as pickle_file:
+        unpickler = cPickle.Unpickler(pickle_file)
+        unpickler.find_global = _find_class
+        return unpickler.load()
+
+# (module, name) of globals really loaded by _load_pickle. Whole modules can't
+# be trusted : copy_reg or __builtin__ also hold functions running anything
+_SAFE_GLOBALS = [
+    ('__builtin__', 'frozenset'),
+    ('__builtin__', 'object'),
+    ('__builtin__', 'set'),
+    ('copy_reg', '_reconstructor'),
+    ('datetime', 'date'),
+    ('datetime', 'datetime'),
+    ('datetime', 'timedelta'),
+    ('decimal', 'Decimal'),
+]
+
+def _find_class(module_name, class_name):
+    if module_name.startswith('buildbot.') and class_name in _RECORDS:
+        return _RECORDS[class_name]
+
+    if (module_name, class_name) in _SAFE_GLOBALS:
+        module = __import__(module_name)
+        return getattr(module, class_name)
+
+    return _IgnoredObject
+
+class _IgnoredObject(object):
+    ''' Stands for any object not needed to create documents '''
+    __slots__ = ()
 
-                yield build
+    def __init__(self, *_, **__):
+        pass
+
+    def __setstate__(self, state):
+        pass
+
+    # Pickled list and dict subclasses are filled after creation
+    def append(self, value):
+        pass
+
+    def extend(self, values):
+        pass
+
+    def __setitem__(self, key, value):
+        pass
+
+class _Record(_IgnoredObject):
+    ''' Only keeps pickled attributes listed in __slots__ '''
+    __slots__ = ()
+
+    def __setstate__(self, state):
+        # Classes with slots are pickled with a (dict, slots dict) state
+        if isinstance(state, tuple):
+            state = dict((state[0] or {}).items() + (state[1] or {}).items())
+        for name in self.__slots__:
+            setattr(self, name, state.get(name))
+
+class _BuilderRecord(_Record):
+    __slots__ = ('name',)
+
+class _BuildRecord(_Record):
+    __slots__ = ('number', 'started', 'finished', 'results', 'blamelist',
+                 'properties', 'steps', 'sources')
+
+class _StepRecord(_Record):
+    __slots__ = ('name', 'step_number', 'started', 'finished', 'results')
+
+class _PropertiesRecord(_Record):
+    __slots__ = ('properties',)
+
+    #pylint: disable=invalid-name
+    def asDict(self):
+        ''' Same as buildbot Properties.asDict '''
+        return dict(self.properties or {})
+
+class _SourceStampRecord(_Record):
+    __slots__ = ('changes',)
+
+class _ChangeRecord(_Record):
+    __slots__ = ('when',)
+
+_RECORDS = {
+    'BuilderStatus' : _BuilderRecord,
+    'BuildStatus' : _BuildRecord,
+    'BuildStepStatus' : _StepRecord,
+    'Properties' : _PropertiesRecord,
+    'SourceStamp' : _SourceStampRecord,
+    'Change' : _ChangeRecord,
+}
 
 def _get_build_properties(build, timezone):
     document = _get_properties('build', build, build, timezone)
 
     trigger_date = 0
     has_changes = False
-    if hasattr(build, 'sources'):
-        for source_stamp in build.sources:
-            if hasattr(source_stamp, 'changes'):
-                for change in source_stamp.changes:
-                    has_changes = True
-                    if trigger_date < change.when:
-                        trigger_date = change.when
+    for source_stamp in build.sources or []:
+        for change in source_stamp.changes or []:
+            has_changes = True
+            if trigger_date < change.when:
+                trigger_date = change.when
 
     if has_changes:
         document['waiting_duration'] = build.started - trigger_date
@@ -267,13 +1748,15 @@ def _get_build_properties(build, timezone):
 
     return document
 
-def _get_step_properties(build, step, timezone):
-    document = _get_properties('step', build, step, timezone)
+def _get_step_properties(build, step, timezone, slim_steps):
+    property_names = _STEP_JOIN_PROPERTIES if slim_steps else None
+    document = _get_properties('step', build, step, timezone, property_names)
     document['step_name'] = step.name
     document['step_number'] = step.step_number
     return document
 
-def _get_properties(doc_type, build, build_or_step, timezone):
+def _get_properties(doc_type, build, build_or_step, timezone,
+                    property_names=None):
     start = datetime.datetime.fromtimestamp(build_or_step.started,
                                             tz=timezone)
     end = datetime.datetime.fromtimestamp(build_or_step.finished,
@@ -285,19 +1768,35 @@ def _get_properties(doc_type, build, build_or_step, timezone):
         'start' : start,
         'end' : end,
         'duration' : build_or_step.finished - build_or_step.started,
-        'result': buildbot.status.builder.Results[build_or_step.results],
+        'result': _RESULTS[build_or_step.results],
     }
 
     for key, value in build.properties.asDict().iteritems():
         if key in ['workdir', 'scheduler', 'builddir']:
             continue
-        value = value[0]
+        if property_names is not None and key not in property_names:
+            continue
+        value = _get_property_value(value[0])
         if value is not None and value != '':
             document[key] = value
 
     return document
 
+def _get_property_value(value):
+    ''' Replaces objects ignored when unpickling by None, so that documents
+        can be serialized '''
+    if isinstance(value, _IgnoredObject):
+        return None
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return [_get_property_value(it) for it in value]
+    if isinstance(value, dict):
+        return dict((key, _get_property_value(it))
+                    for key, it in value.iteritems())
+    return value
+
 def _get_action(index, doc_type, doc_id, body):
+    if 'start' in body:
+        index = _get_index_name(index, body['start'])
     return {
         "_index": index,
         "_type": doc_type,
@@ -0,0 +1,101 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Copyright © 2014—2016 Dontnod Entertainment
+
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+''' Measures elastic_bot document extraction on a buildbot master directory '''
+
+import argparse
+import collections
+import json
+import sys
+import time
+
+import dateutil.tz
+
+import elastic_bot
+
+#pylint: disable=protected-access
+
+def main():
+    ''' Entry Point '''
+    args = _load_arguments()
+    elastic_bot._init_logging(False)
+    timezone = dateutil.tz.tzlocal()
+
+    build_paths = []
+    errors = collections.Counter()
+    # A fresh checkpoint lists all builds, without touching the indexer one
+    checkpoint = elastic_bot._Checkpoint()
+    for builder_name, builder_dir in elastic_bot._discover_builders(args.builders_dir, None, 1, None, errors):
+        for build_pickle_path in elastic_bot._get_build_paths(builder_name, builder_dir, checkpoint):
+            build_paths.append((builder_name, build_pickle_path))
+    build_paths = build_paths[:args.limit]
+
+    print 'Benchmarking %s builds from %s' % (len(build_paths), args.builders_dir)
+    results = {}
+    for slim_steps in [False, True]:
+        results[slim_steps] = _run(build_paths, timezone, slim_steps)
+
+    print '%-12s %10s %10s %14s %14s %10s' % ('mode', 'builds', 'steps', 'build bytes', 'step bytes', 'seconds')
+    for slim_steps, stats in sorted(results.iteritems()):
+        print '%-12s %10s %10s %14s %14s %10.2f' % ('slim steps' if slim_steps else 'full steps',
+                                                    stats['build'], stats['step'],
+                                                    stats['build bytes'], stats['step bytes'],
+                                                    stats['duration'])
+
+    full_bytes = results[False]['build bytes'] + results[False]['step bytes']
+    slim_bytes = results[True]['build bytes'] + results[True]['step bytes']
+    if full_bytes > 0:
+        print 'Slim steps reduce document size by %.1f%%' % (100.0 * (full_bytes - slim_bytes) / full_bytes)
+
+    return 0
+
+def _load_arguments():
+    parser = argparse.ArgumentParser(description=('Measures the size and the '
+                                                  'extraction time of documents '
+                                                  'created by elastic_bot.'))
+    parser.add_argument('--builders-dir',
+                        metavar='<dir>',
+                        default='.',
+                        help='Directory where are stored the buildbot logs')
+
+    parser.add_argument('--limit',
+                        metavar='<count>',
+                        type=int,
+                        default=1000,
+                        help='Maximum number of builds to load')
+
+    return parser.parse_args()
+
+def _run(build_paths, timezone, slim_steps):
+    stats = collections.defaultdict(int)
+    start = time.time()
+    for builder_name, build_pickle_path in build_paths:
+        _, _, actions = elastic_bot._get_build_actions('benchmark', builder_name, build_pickle_path, timezone, slim_steps)
+        for action in actions or []:
+            document = json.dumps(action['_source'], default=elastic_bot._to_json_value)
+            stats[action['_type']] += 1
+            stats[action['_type'] + ' bytes'] += len(document)
+    stats['duration'] = time.time() - start
+    return stats
+
+if __name__ == '__main__':
+    sys.exit(main())
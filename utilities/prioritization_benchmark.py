@@ -0,0 +1,211 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Copyright © 2014—2016 Dontnod Entertainment
+
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+''' Simulates an overloaded build farm to compare queue latencies of ebb
+    builder prioritization settings '''
+
+import argparse
+import collections
+import heapq
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import ebb
+
+#pylint: disable=protected-access
+
+# Category : (builders count, priority, fair share, minutes between requests
+# of a builder, build minutes)
+_CATEGORIES = {
+    'gate' : (4, 20, 2, 6, 15),
+    'package' : (4, 10, 1, 20, 40),
+    'tools' : (4, 0, 1, 30, 20),
+}
+
+# Mode : (priority aging, use fair share)
+_MODES = [
+    ('static', (None, False)),
+    ('aging', (1, False)),
+    ('fair share', (None, True)),
+    ('aging + fair share', (1, True)),
+]
+
+_PERCENTILES = [50, 90, 99]
+
+def main():
+    ''' Entry Point '''
+    args = _load_arguments()
+
+    print ('Simulating %s hours of requests on %s slaves'
+           % (args.hours, args.slaves))
+    header = '%-20s %-10s %8s %8s' % ('mode', 'category', 'started', 'waiting')
+    header += ''.join(' %7s' % ('p%s' % it) for it in _PERCENTILES)
+    print header + ' %7s %12s' % ('max', 'sort µs')
+
+    for mode, (aging, fair_share) in _MODES:
+        random.seed(args.seed)
+        waits, waiting, sort_duration = _simulate(args, aging, fair_share)
+        for category in sorted(_CATEGORIES):
+            category_waits = sorted(waits[category])
+            line = '%-20s %-10s %8s %8s' % (mode, category,
+                                            len(category_waits) -
+                                            waiting[category],
+                                            waiting[category])
+            for percentile in _PERCENTILES + [100]:
+                line += ' %7.1f' % _get_percentile(category_waits, percentile)
+            print line + ' %12.1f' % sort_duration
+
+    print ('Latencies are in minutes. Requests still waiting at the end are '
+           'counted with their age then, a lower bound of their latency : '
+           'otherwise a starved category would only show the requests that '
+           'got lucky')
+    return 0
+
+def _load_arguments():
+    parser = argparse.ArgumentParser(description=('Compares queue latencies of '
+                                                  'ebb builder prioritization '
+                                                  'settings on a simulated '
+                                                  'build farm.'))
+    parser.add_argument('--slaves',
+                        metavar='<count>',
+                        type=int,
+                        default=20,
+                        help='Number of slaves, all able to run all builders')
+
+    parser.add_argument('--hours',
+                        metavar='<hours>',
+                        type=float,
+                        default=24,
+                        help='Duration during which requests are submitted')
+
+    parser.add_argument('--seed',
+                        metavar='<seed>',
+                        type=int,
+                        default=0,
+                        help='Random seed, the same for all modes')
+
+    return parser.parse_args()
+
+class _Builder(object):
+    ''' Mimics the buildbot builder attributes read by prioritization '''
+    def __init__(self, name, category, clock):
+        self.name = name
+        self.category = category
+        self.building = []
+        self.pending = collections.deque()
+        self._clock = clock
+
+    #pylint: disable=invalid-name
+    def getOldestRequestTime(self):
+        ''' Returns the submission time of the oldest pending request '''
+        if not self.pending:
+            return None
+        # Prioritization measures ages from the current time
+        return time.time() - (self._clock[0] - self.pending[0])
+
+class _Master(object):
+    ''' Mimics the buildbot master attributes read by prioritization '''
+    def __init__(self, builders):
+        self.botmaster = self
+        self.builders = dict((it.name, it) for it in builders)
+
+def _simulate(args, aging, fair_share):
+    clock = [0.0]
+    config = ebb.Config()
+    builders = []
+    events = []
+    with config:
+        for category, (count, priority, share, interval, _) in _CATEGORIES.iteritems():
+            for index in range(count):
+                name = '%s-%s' % (category, index)
+                with ebb.Builder(name, category) as scope:
+                    ebb.Builder.config(priority=priority,
+                                       priority_aging=aging,
+                                       fair_share=share if fair_share else None)
+                builder = _Builder(name, category, clock)
+                config.add_builder(builder, scope)
+                builders.append(builder)
+
+                submit_time = random.expovariate(1.0 / interval)
+                while submit_time < args.hours * 60:
+                    heapq.heappush(events, (submit_time, 'submit', builder))
+                    submit_time += random.expovariate(1.0 / interval)
+
+    master = _Master(builders)
+    waits = collections.defaultdict(list)
+    free_slaves = args.slaves
+    sort_count, sort_duration = 0, 0.0
+    while events and events[0][0] < args.hours * 60:
+        clock[0], event, builder = heapq.heappop(events)
+        if event == 'submit':
+            builder.pending.append(clock[0])
+        else:
+            builder.building.pop()
+            free_slaves += 1
+
+        # Like the buildbot build request distributor, start builds in
+        # prioritized order while slaves are available
+        started = True
+        while started and free_slaves > 0:
+            started = False
+            pending_builders = [it for it in builders if it.pending]
+            if not pending_builders:
+                break
+
+            start = time.time()
+            order = []
+            config._prioritize_builders(master, pending_builders).addCallback(order.extend)
+            sort_duration += time.time() - start
+            sort_count += 1
+
+            for builder in order:
+                if free_slaves == 0:
+                    break
+                submit_time = builder.pending.popleft()
+                waits[builder.category].append(clock[0] - submit_time)
+                builder.building.append(submit_time)
+                free_slaves -= 1
+                started = True
+                build_minutes = _CATEGORIES[builder.category][4]
+                end_time = clock[0] + random.expovariate(1.0 / build_minutes)
+                heapq.heappush(events, (end_time, 'finish', builder))
+
+    waiting = collections.Counter()
+    for builder in builders:
+        waiting[builder.category] += len(builder.pending)
+        for submit_time in builder.pending:
+            waits[builder.category].append(args.hours * 60 - submit_time)
+
+    return waits, waiting, 1000000 * sort_duration / max(sort_count, 1)
+
+def _get_percentile(values, percentile):
+    if not values:
+        return 0.0
+    index = int(round(percentile / 100.0 * (len(values) - 1)))
+    return values[index]
+
+if __name__ == '__main__':
+    sys.exit(main())